@@ -1,16 +1,26 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, Header, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+import asyncio
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, NamedTuple, Optional, Tuple, Union
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from bson import ObjectId
+from collections import OrderedDict
+import base64
+import hashlib
 import json
+import time
+import unicodedata
 
 
 # Custom JSON encoder to handle ObjectId
@@ -29,6 +39,85 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Operational counters, exposed through /api/admin/metrics
+metrics = {
+    "cart_cas_retries": 0,  # version mismatches that triggered a retry
+    "cart_cas_conflicts": 0,  # updates that gave up after CART_CAS_ATTEMPTS
+    "cart_flushes": 0,  # bulk writes made by the write-behind cart store
+    "cart_flushed_carts": 0,  # carts written by those flushes
+    "reservations_expired": 0,  # holds released by the expiry sweep
+    "jobs_done": 0,  # post-order jobs completed
+    "jobs_retried": 0,  # failed job attempts scheduled again
+    "jobs_dead": 0,  # jobs dead-lettered after JOB_MAX_ATTEMPTS
+}
+
+# Cart store: "mongo" writes every cart mutation straight to the database;
+# "memory" keeps hot carts in process and flushes them in batches (write-behind).
+# The memory store assumes a single server process owns the carts.
+CART_STORE = os.environ.get('CART_STORE', 'mongo')
+CART_CACHE_SIZE = int(os.environ.get('CART_CACHE_SIZE', '10000'))
+# Durability of the memory store: "sync" flushes each mutation before replying,
+# "interval" flushes every CART_FLUSH_INTERVAL seconds and can lose that much
+# on a crash
+CART_DURABILITY = os.environ.get('CART_DURABILITY', 'interval')
+CART_FLUSH_INTERVAL = float(os.environ.get('CART_FLUSH_INTERVAL', '1'))
+
+# Carts untouched for this many days are removed by a TTL index on updated_at
+CART_TTL_DAYS = float(os.environ.get('CART_TTL_DAYS', '30'))
+
+# Stock held by a cart line is released after this long without cart activity
+RESERVATION_HOLD_MINUTES = float(os.environ.get('RESERVATION_HOLD_MINUTES', '30'))
+# Days released and converted holds are kept before a TTL index removes them
+RESERVATION_RETENTION_DAYS = float(os.environ.get('RESERVATION_RETENTION_DAYS', '7'))
+# Seconds between sweeps for expired holds
+RESERVATION_SWEEP_INTERVAL = float(os.environ.get('RESERVATION_SWEEP_INTERVAL', '60'))
+
+# Idempotency-Key records for order creation: hours they are kept, and how
+# long a duplicate request waits for the original to finish (seconds)
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '10'))
+IDEMPOTENCY_POLL_INTERVAL = 0.1
+# A claim not completed within this many seconds (e.g. its process died) can be taken over
+IDEMPOTENCY_LEASE_SECONDS = float(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '60'))
+
+# Order numbers reserved from the daily counter per $inc
+ORDER_NUMBER_BLOCK = int(os.environ.get('ORDER_NUMBER_BLOCK', '20'))
+
+# Post-order jobs: where messages go ("log" or "memory"), worker count,
+# attempts before a job is dead-lettered, first retry delay (seconds, doubled
+# per attempt), how long a claimed job is leased and how long finished jobs are kept
+JOB_SINK = os.environ.get('JOB_SINK', 'log')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', '2'))
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '60'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '5'))
+JOB_RETENTION_DAYS = float(os.environ.get('JOB_RETENTION_DAYS', '7'))
+
+# Catalog cache settings (seconds / number of cached listings)
+CATALOG_CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL', '300'))
+CATALOG_CACHE_SIZE = int(os.environ.get('CATALOG_CACHE_SIZE', '256'))
+
+# Product pricing snapshots used by cart and checkout (seconds / number of products)
+SNAPSHOT_CACHE_TTL = float(os.environ.get('SNAPSHOT_CACHE_TTL', '60'))
+SNAPSHOT_CACHE_SIZE = int(os.environ.get('SNAPSHOT_CACHE_SIZE', '5000'))
+
+# Largest page a listing endpoint will return
+MAX_PAGE_SIZE = 100
+# Most products returned by the unpaginated (plain list) product listing;
+# when more match, the X-Next-Cursor header says where to continue
+MAX_LIST_SIZE = int(os.environ.get('MAX_LIST_SIZE', '1000'))
+
+# Lower bounds of the price bands used for facet counts (VND)
+PRICE_BANDS = [0, 500000, 1000000, 2000000, 5000000]
+
+# Attempts for a compare-and-swap cart update before giving up with 409
+CART_CAS_ATTEMPTS = 5
+
+# Bulk import: upserts per bulk_write and how many line errors to report back
+IMPORT_BATCH_SIZE = 500
+MAX_IMPORT_ERRORS = 1000
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -41,7 +130,7 @@ class SizeOption(BaseModel):
     size: str  # "Nhỏ (5g)", "Vừa (10g)", "Lớn (20g)"
     price: float
     original_price: Optional[float] = None
-    stock: int = 0
+    stock: int = 0  # units free to reserve; imports and on_hand product updates give stock on hand (see without_holds)
 
 class Product(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -72,15 +161,33 @@ class CartItem(BaseModel):
     quantity: int = 1
     total_price: float = 0
 
+# API shape of a cart; stored documents keep items as a keyed ``lines`` map
 class Cart(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     session_id: str  # For guest users
     items: List[CartItem] = []
     total_amount: float = 0
     total_items: int = 0
+    # Bumped by every write; read-modify-write updates compare-and-swap on it
+    version: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
+# Stock held for a cart line; quantity has already been taken out of the
+# product's size_options[].stock
+class StockReservation(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    session_id: str
+    product_id: str
+    size: str
+    quantity: int
+    status: str = "held"  # held, released, converted
+    order_id: Optional[str] = None
+    expires_at: datetime
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    finished_at: Optional[datetime] = None  # set once released or converted
+
 # Order Models
 class CustomerInfo(BaseModel):
     full_name: str
@@ -104,7 +211,7 @@ class OrderItem(BaseModel):
 
 class Order(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    order_number: str = Field(default_factory=lambda: f"KTH{datetime.now().strftime('%Y%m%d')}{str(uuid.uuid4())[:8].upper()}")
+    order_number: str  # see OrderNumberAllocator
     customer_info: CustomerInfo
     items: List[OrderItem]
     payment_method: str  # "cod" or "bank_transfer"
@@ -117,6 +224,52 @@ class Order(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
+class ProductPage(BaseModel):
+    items: List[Product]
+    next_cursor: Optional[str] = None
+
+class OrderPage(BaseModel):
+    items: List[Order]
+    next_cursor: Optional[str] = None
+
+# Order history as shown to customers: no street address
+class CustomerContact(BaseModel):
+    full_name: str
+    phone: str
+    email: str
+    city: str
+
+class CustomerOrder(Order):
+    customer_info: CustomerContact
+
+class CustomerOrderPage(BaseModel):
+    items: List[CustomerOrder]
+    next_cursor: Optional[str] = None
+
+# Slim product shape for listing cards (?view=card)
+class ProductCard(BaseModel):
+    id: str
+    name: str
+    name_en: str
+    price: float
+    original_price: Optional[float] = None
+    image_url: str
+    category: str
+
+PRODUCT_CARD_FIELDS = list(ProductCard.model_fields)
+
+class CartOperation(BaseModel):
+    op: str  # "add", "update" or "remove"
+    product_id: str
+    size: str
+    quantity: int = 0
+
+class CartBatch(BaseModel):
+    operations: List[CartOperation]
+
+class ProductLookup(BaseModel):
+    ids: List[str]
+
 class ProductCreate(BaseModel):
     name: str
     name_en: str
@@ -147,52 +300,1743 @@ class ProductUpdate(BaseModel):
     featured: Optional[bool] = None
     specifications: Optional[dict] = None
 
+# In-process caches
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after a fixed TTL"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Bumped on every clear so readers can detect a write that raced them
+        self.generation = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, generation: Optional[int] = None):
+        # Drop results computed before the last invalidation
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+# Encoded catalog responses keyed by their query parameters
+catalog_cache = TTLCache(maxsize=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL)
+
+# Compact pricing view of a product, keyed by product id
+snapshot_cache = TTLCache(maxsize=SNAPSHOT_CACHE_SIZE, ttl=SNAPSHOT_CACHE_TTL)
+
+def invalidate_catalog(product_id: Optional[str] = None):
+    """Drop cached catalog data after a write to one product, or to any number of them"""
+    catalog_cache.clear()
+    if product_id is None:
+        snapshot_cache.clear()
+    else:
+        snapshot_cache.pop(product_id)
+
+# Product pricing snapshots
+class SizePrice(NamedTuple):
+    price: float
+    original_price: Optional[float]
+    stock: int
+
+class ProductSnapshot(NamedTuple):
+    id: str
+    name: str
+    image_url: str
+    sizes: dict  # size -> SizePrice
+
+    def cart_item(self, size: str, quantity: int) -> CartItem:
+        size_price = self.sizes[size]
+        return CartItem(
+            product_id=self.id,
+            product_name=self.name,
+            product_image=self.image_url,
+            size=size,
+            size_price=size_price.price,
+            original_price=size_price.original_price,
+            quantity=quantity,
+            total_price=size_price.price * quantity
+        )
+
+SNAPSHOT_PROJECTION = {"_id": 0, "id": 1, "name": 1, "image_url": 1, "size_options": 1}
+
+def product_snapshot(product: dict) -> ProductSnapshot:
+    return ProductSnapshot(
+        id=product["id"],
+        name=product["name"],
+        image_url=product["image_url"],
+        sizes={
+            size["size"]: SizePrice(size["price"], size.get("original_price"), size.get("stock", 0))
+            for size in product.get("size_options", [])
+        }
+    )
+
+async def get_product_snapshots(product_ids) -> dict:
+    """Pricing snapshots for the given products, loading cache misses with one $in query"""
+    snapshots = {}
+    missing = []
+    for product_id in set(product_ids):
+        snapshot = snapshot_cache.get(product_id)
+        if snapshot is None:
+            missing.append(product_id)
+        else:
+            snapshots[product_id] = snapshot
+    
+    if missing:
+        generation = snapshot_cache.generation
+        async for product in db.products.find({"id": {"$in": missing}}, SNAPSHOT_PROJECTION):
+            snapshot = product_snapshot(product)
+            snapshot_cache.set(product["id"], snapshot, generation)
+            snapshots[product["id"]] = snapshot
+    return snapshots
+
+def reprice_lines(lines: dict, products: dict, product_ids: set) -> Tuple[dict, list]:
+    """Bring cart lines for ``product_ids`` in line with current snapshots.
+
+    Lines whose product or size no longer exists are dropped. Returns the
+    lines and a list of price changes (``new_price`` is None for dropped lines).
+    """
+    changes = []
+    for key, line in list(lines.items()):
+        if line["product_id"] not in product_ids:
+            continue
+        product = products.get(line["product_id"])
+        if product is None or line["size"] not in product.sizes:
+            del lines[key]
+            changes.append({"product_id": line["product_id"], "size": line["size"], "old_price": line["size_price"], "new_price": None})
+            continue
+        current = product.cart_item(line["size"], line["quantity"]).dict()
+        if current != line:
+            if current["size_price"] != line["size_price"]:
+                changes.append({"product_id": line["product_id"], "size": line["size"], "old_price": line["size_price"], "new_price": current["size_price"]})
+            lines[key] = current
+    return lines, changes
+
+# Pre-serialized responses
+class EncodedResponse(NamedTuple):
+    body: bytes
+    etag: str
+    headers: dict = {}
+
+def encode_response(content, headers: Optional[dict] = None) -> EncodedResponse:
+    """Encode content once, tagging it with a hash of the encoded bytes.
+
+    Hashing the body rather than document versions keeps the tag honest for
+    writes that don't touch updated_at, such as stock holds.
+    """
+    body = json.dumps(jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return EncodedResponse(body=body, etag=f'"{hashlib.sha1(body).hexdigest()}"', headers=headers or {})
+
+def send_encoded(request: Request, encoded: EncodedResponse) -> Response:
+    """Send encoded bytes, or 304 when the client already holds this version"""
+    headers = {**encoded.headers, "ETag": encoded.etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    client_tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if encoded.etag in client_tags or "*" in client_tags:
+        return Response(status_code=304, headers=headers)
+    return Response(content=encoded.body, media_type="application/json", headers=headers)
+
+# Keyset pagination helpers
+# Listings are ordered by (created_at desc, id desc); a cursor carries that pair
+# for the last document of a page so the next page can seek past it.
+def encode_cursor(doc: dict) -> str:
+    raw = json.dumps([doc["created_at"].isoformat(), doc["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, last_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), str(last_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_query(query: dict, cursor: Optional[str]) -> dict:
+    """Restrict a query to documents after the given cursor"""
+    if not cursor:
+        return query
+    created_at, last_id = decode_cursor(cursor)
+    after_cursor = {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "id": {"$lt": last_id}}
+    ]}
+    return {"$and": [query, after_cursor]} if query else after_cursor
+
+KEYSET_SORT = [("created_at", -1), ("id", -1)]
+
+async def fetch_page(collection, query: dict, limit: int, cursor: Optional[str], projection: Optional[dict] = None):
+    """Fetch one keyset page, returning (documents, next_cursor)"""
+    if projection is not None:
+        # The cursor is built from the sort keys, so they must survive the projection
+        projection = {**projection, "created_at": 1, "id": 1}
+    docs = await collection.find(keyset_query(query, cursor), projection).sort(KEYSET_SORT).limit(limit + 1).to_list(limit + 1)
+    next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+    return docs[:limit], next_cursor
+
+# Sparse fieldsets
+def product_fields(fields: Optional[str], view: Optional[str]) -> Optional[List[str]]:
+    """Resolve the ``fields``/``view`` parameters to the list of fields to return"""
+    if view == "card":
+        return PRODUCT_CARD_FIELDS
+    if view not in (None, "full"):
+        raise HTTPException(status_code=400, detail=f"Unknown view: {view}")
+    if not fields:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in Product.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return ["id"] + [field for field in requested if field != "id"]
+
+def product_projection(fields: Optional[List[str]]) -> Optional[dict]:
+    if fields is None:
+        return None
+    return {"_id": 0, **{field: 1 for field in fields}}
+
+def render_product(doc: dict, fields: Optional[List[str]]) -> dict:
+    if fields is None:
+        return Product(**doc).dict()
+    if fields is PRODUCT_CARD_FIELDS:
+        return ProductCard(**doc).dict()
+    return {field: doc[field] for field in fields if field in doc}
+
+# Derived product fields
+# Stored alongside each product so queries can be index-served; they are not
+# part of the Product model and never leave the server.
+def fold_text(text: str) -> str:
+    """Lowercase and strip Vietnamese diacritics ("Trầm Hương" -> "tram huong")"""
+    decomposed = unicodedata.normalize("NFD", text.replace("đ", "d").replace("Đ", "D"))
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+def derived_fields(product: dict) -> dict:
+    # Products without size options are priced and stocked at the product level
+    sizes = product.get("size_options") or []
+    prices = [size["price"] for size in sizes] or [product.get("price", 0)]
+    stock = sum(size.get("stock", 0) for size in sizes) if sizes else product.get("stock", 0)
+    return {
+        "search_name": fold_text(f"{product.get('name', '')} {product.get('name_en', '')}"),
+        "search_description": fold_text(f"{product.get('description', '')} {product.get('description_en', '')}"),
+        "min_size_price": min(prices),
+        "max_size_price": max(prices),
+        "total_size_stock": stock,
+    }
+
+DERIVED_FIELDS = list(derived_fields({}))
+
+def product_document(product: Product) -> dict:
+    """Build the stored document for a product, including derived fields"""
+    doc = product.dict()
+    doc.update(derived_fields(doc))
+    return doc
+
+async def backfill_derived_fields():
+    """Fill in derived fields for products written before they existed"""
+    updates = []
+    missing = {"$or": [{field: {"$exists": False}} for field in DERIVED_FIELDS]}
+    async for product in db.products.find(missing):
+        updates.append(UpdateOne({"_id": product["_id"]}, {"$set": derived_fields(product)}))
+        if len(updates) >= 500:
+            await db.products.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        await db.products.bulk_write(updates, ordered=False)
+
+async def lookup_products(ids: List[str], selected: Optional[List[str]]) -> dict:
+    """Resolve many product IDs with one $in query, keeping the requested order"""
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PAGE_SIZE} ids per lookup")
+    found = {
+        doc["id"]: doc
+        async for doc in db.products.find({"id": {"$in": ids}}, product_projection(selected))
+    }
+    return {
+        "items": [render_product(found[product_id], selected) for product_id in ids if product_id in found],
+        "missing": [product_id for product_id in ids if product_id not in found]
+    }
+
+async def compute_facets() -> dict:
+    """Count products per category, price band and stock status in one aggregation"""
+    pipeline = [{"$facet": {
+        "categories": [
+            {"$group": {"_id": "$category", "count": {"$sum": 1}}},
+            {"$sort": {"_id": 1}}
+        ],
+        "price_bands": [
+            {"$bucket": {
+                "groupBy": "$min_size_price",
+                "boundaries": PRICE_BANDS,
+                "default": PRICE_BANDS[-1],
+                "output": {"count": {"$sum": 1}}
+            }}
+        ],
+        "stock": [
+            {"$group": {"_id": {"$gt": ["$total_size_stock", 0]}, "count": {"$sum": 1}}}
+        ]
+    }}]
+    result = (await db.products.aggregate(pipeline).to_list(1))[0]
+    
+    band_counts = {band["_id"]: band["count"] for band in result["price_bands"]}
+    stock_counts = {group["_id"]: group["count"] for group in result["stock"]}
+    uppers = PRICE_BANDS[1:] + [None]
+    return {
+        "categories": [{"category": group["_id"], "count": group["count"]} for group in result["categories"]],
+        "price_bands": [
+            {"min": lower, "max": upper, "count": band_counts.get(lower, 0)}
+            for lower, upper in zip(PRICE_BANDS, uppers)
+        ],
+        "stock": {"in_stock": stock_counts.get(True, 0), "out_of_stock": stock_counts.get(False, 0)}
+    }
+
+# NDJSON bulk import helpers
+async def iter_lines(stream):
+    """Split a byte stream into lines without buffering the whole body"""
+    buffer = b""
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+def import_product(data: dict) -> Tuple[str, dict]:
+    """Validate one import line, returning the product id and its fields"""
+    product_id = str(data.pop("id", None) or uuid.uuid4())
+    return product_id, ProductCreate(**data).dict()
+
+def import_operation(product_id: str, fields: dict, held: dict) -> UpdateOne:
+    """Build the upsert for one imported product; its stock is stock on hand"""
+    fields = {**fields, "size_options": without_holds(product_id, fields["size_options"], held)}
+    now = datetime.utcnow()
+    return UpdateOne(
+        {"id": product_id},
+        {
+            "$set": {**fields, **derived_fields(fields), "updated_at": now},
+            "$setOnInsert": {"id": product_id, "created_at": now}
+        },
+        upsert=True
+    )
+
+async def flush_import_batch(products: List[tuple], line_numbers: List[int], report: dict):
+    """Write one batch of upserts and merge the outcome into the report"""
+    held = await held_stock([product_id for product_id, _ in products])
+    operations = [import_operation(product_id, fields, held) for product_id, fields in products]
+    try:
+        result = await db.products.bulk_write(operations, ordered=False)
+        details = result.bulk_api_result
+    except BulkWriteError as e:
+        details = e.details
+        for error in details.get("writeErrors", []):
+            report_import_error(report, line_numbers[error["index"]], error.get("errmsg", "write failed"))
+    report["inserted"] += details.get("nUpserted", 0)
+    report["updated"] += details.get("nMatched", 0)
+
+def report_import_error(report: dict, line_number: int, message: str):
+    report["failed"] += 1
+    if len(report["errors"]) < MAX_IMPORT_ERRORS:
+        report["errors"].append({"line": line_number, "error": message})
+
+# Database indexes
+# Every route lookup is backed by one of these; create_indexes is idempotent, so
+# they are (re)declared on each startup.
+INDEXES = {
+    "products": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("featured", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="featured_created_at_id"),
+        IndexModel([("category", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="category_created_at_id"),
+        IndexModel([("min_size_price", ASCENDING), ("max_size_price", ASCENDING)], name="size_price_range"),
+        IndexModel([("total_size_stock", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="size_stock_created_at_id"),
+        IndexModel(
+            [("search_name", TEXT), ("search_description", TEXT)],
+            name="search_text",
+            weights={"search_name": 10, "search_description": 2},
+            # Bilingual content: no stemming or stop words for either language
+            default_language="none"
+        ),
+    ],
+    "carts": [
+        IndexModel([("session_id", ASCENDING)], name="session_id_unique", unique=True),
+        IndexModel([("updated_at", ASCENDING)], name="updated_at_ttl", expireAfterSeconds=int(CART_TTL_DAYS * 86400)),
+    ],
+    "stock_reservations": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # At most one live hold per cart line
+        IndexModel(
+            [("session_id", ASCENDING), ("product_id", ASCENDING), ("size", ASCENDING)],
+            name="session_line_held_unique",
+            unique=True,
+            partialFilterExpression={"status": "held"}
+        ),
+        IndexModel([("status", ASCENDING), ("expires_at", ASCENDING)], name="status_expires_at"),
+        IndexModel([("product_id", ASCENDING), ("status", ASCENDING)], name="product_id_status"),
+        # Only holds that are no longer live have finished_at
+        IndexModel([("finished_at", ASCENDING)], name="finished_at_ttl", expireAfterSeconds=int(RESERVATION_RETENTION_DAYS * 86400)),
+    ],
+    "order_jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)], name="status_run_at"),
+        IndexModel([("order_id", ASCENDING)], name="order_id"),
+        # Only completed jobs get finished_at; dead ones stay until handled
+        IndexModel([("finished_at", ASCENDING)], name="finished_at_ttl", expireAfterSeconds=int(JOB_RETENTION_DAYS * 86400)),
+    ],
+    "idempotency_keys": [
+        IndexModel([("scope", ASCENDING), ("key", ASCENDING)], name="scope_key_unique", unique=True),
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=int(IDEMPOTENCY_TTL_HOURS * 3600)),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("order_number", ASCENDING)], name="order_number_unique", unique=True),
+        # One order per Idempotency-Key, even if two requests end up holding the claim
+        IndexModel(
+            [("idempotency_key", ASCENDING)],
+            name="idempotency_key_unique",
+            unique=True,
+            partialFilterExpression={"idempotency_key": {"$exists": True}}
+        ),
+        # Order listings: one keyset index per filter, plus the unfiltered / date range one
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("order_status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="order_status_created_at_id"),
+        IndexModel([("payment_status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="payment_status_created_at_id"),
+        IndexModel([("customer_info.phone", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="phone_created_at_id"),
+        IndexModel([("customer_info.email", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="email_created_at_id"),
+    ],
+}
+
+# Representative query for each route lookup: (route, collection, filter, sort)
+ROUTE_QUERIES = [
+    ("get_products", "products", {}, KEYSET_SORT),
+    ("get_products?featured", "products", {"featured": True}, KEYSET_SORT),
+    ("get_products?category", "products", {"category": ""}, KEYSET_SORT),
+    ("get_products?price", "products", {"min_size_price": {"$lte": 0}, "max_size_price": {"$gte": 0}}, KEYSET_SORT),
+    ("get_products?in_stock", "products", {"total_size_stock": {"$gt": 0}}, KEYSET_SORT),
+    ("get_product", "products", {"id": ""}, None),
+    ("search_products", "products", {"$text": {"$search": "tram"}}, None),
+    ("cart", "carts", {"session_id": ""}, None),
+    ("stock_reservation", "stock_reservations", {"session_id": "", "product_id": "", "size": "", "status": "held"}, None),
+    ("expire_reservations", "stock_reservations", {"status": "held", "expires_at": {"$lte": datetime(2000, 1, 1)}}, None),
+    ("claim_job", "order_jobs", {"status": "pending", "run_at": {"$lte": datetime(2000, 1, 1)}}, [("run_at", 1)]),
+    ("get_order", "orders", {"id": ""}, None),
+    ("get_order_by_number", "orders", {"order_number": ""}, None),
+    ("order_by_idempotency_key", "orders", {"idempotency_key": ""}, None),
+    ("list_orders", "orders", {}, KEYSET_SORT),
+    ("list_orders?created", "orders", {"created_at": {"$gte": datetime(2000, 1, 1)}}, KEYSET_SORT),
+    ("list_orders?order_status", "orders", {"order_status": ""}, KEYSET_SORT),
+    ("list_orders?payment_status", "orders", {"payment_status": ""}, KEYSET_SORT),
+    ("list_orders?phone", "orders", {"customer_info.phone": ""}, KEYSET_SORT),
+    ("list_orders?email", "orders", {"customer_info.email": ""}, KEYSET_SORT),
+    ("customer_orders", "orders", {"customer_info.phone": "", "customer_info.email": ""}, KEYSET_SORT),
+]
+
+# Index bootstrap progress: pending -> building -> ready | degraded
+index_state = {"status": "pending", "collections": {}, "collscans": []}
+
+async def sync_ttl_indexes(collection: str, models: List[IndexModel]):
+    """Apply a changed expiry to existing TTL indexes, which create_indexes would reject"""
+    existing = await db[collection].index_information()
+    for model in models:
+        spec = model.document
+        current = existing.get(spec["name"])
+        if "expireAfterSeconds" in spec and current and current.get("expireAfterSeconds") != spec["expireAfterSeconds"]:
+            await db.command("collMod", collection, index={
+                "name": spec["name"],
+                "expireAfterSeconds": spec["expireAfterSeconds"]
+            })
+
+def plan_has_collscan(plan) -> bool:
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(plan_has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(plan_has_collscan(value) for value in plan)
+    return False
+
+async def find_collscans() -> List[str]:
+    """Explain every route query and return the ones planned as a collection scan"""
+    collscans = []
+    for route, collection, query, sort in ROUTE_QUERIES:
+        cursor = db[collection].find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            explain = await cursor.explain()
+        except OperationFailure:
+            # $text without its index fails outright rather than scanning
+            collscans.append(route)
+            continue
+        if plan_has_collscan(explain.get("queryPlanner", {}).get("winningPlan")):
+            collscans.append(route)
+    return collscans
+
+async def ensure_indexes():
+    """Create all declared indexes and flag route queries that still scan"""
+    index_state["status"] = "building"
+    await backfill_derived_fields()
+    for collection, models in INDEXES.items():
+        try:
+            await sync_ttl_indexes(collection, models)
+            await db[collection].create_indexes(models)
+            index_state["collections"][collection] = "ready"
+        except OperationFailure as e:
+            # e.g. duplicate keys blocking a unique index; keep serving without it
+            logger.error(f"Index build failed for {collection}: {e}")
+            index_state["collections"][collection] = f"failed: {e}"
+    
+    try:
+        index_state["collscans"] = await find_collscans()
+    except OperationFailure as e:
+        logger.error(f"Could not explain route queries: {e}")
+    for route in index_state["collscans"]:
+        logger.warning(f"Query for {route} runs as a collection scan")
+    
+    failed = any(state != "ready" for state in index_state["collections"].values())
+    index_state["status"] = "degraded" if failed or index_state["collscans"] else "ready"
+
+# Cart line storage
+# Stored carts keep their lines in a ``lines`` map keyed by line_key(product_id,
+# size), so a line is found and updated by path (``lines.<key>.quantity``)
+# instead of by scanning an array. API responses still expose an ``items`` list.
+# Carts stored with the old ``items`` array are converted on their next write.
+def line_key(product_id: str, size: str) -> str:
+    """Map key for a cart line; "." and "$" are escaped so it is a valid field name"""
+    raw = f"{product_id}|{size}"
+    return raw.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+def cart_lines(cart: dict) -> dict:
+    if "lines" in cart:
+        return cart["lines"]
+    return {line_key(line["product_id"], line["size"]): line for line in cart.get("items", [])}
+
+def cart_document(cart: Cart) -> dict:
+    doc = cart.dict(exclude={"items"})
+    doc["lines"] = {line_key(line.product_id, line.size): line.dict() for line in cart.items}
+    return doc
+
+def cart_view(cart: dict) -> dict:
+    """Shape a stored cart for API responses"""
+    view = {field: value for field, value in cart.items() if field != "lines"}
+    view["items"] = list(cart_lines(cart).values())
+    if "_id" in view:
+        view["_id"] = str(view["_id"])
+    return view
+
+CART_VIEWS = ("full", "delta")
+CART_DELTA_PROJECTION = {"_id": 0, "session_id": 1, "version": 1, "total_items": 1, "total_amount": 1, "updated_at": 1}
+
+def cart_view_param(view: Optional[str]) -> str:
+    if view not in (None,) + CART_VIEWS:
+        raise HTTPException(status_code=400, detail=f"Unknown view: {view}")
+    return view or "full"
+
+def cart_response(cart: dict, view: str, keys: List[str], before: Optional[dict] = None) -> dict:
+    """Shape the result of a cart mutation.
+
+    The delta view carries only the lines under ``keys`` that still exist,
+    the ones that were removed, and the new totals and version.
+    """
+    if view != "delta":
+        return cart_view(cart)
+    lines = cart_lines(cart)
+    before = before or {}
+    return {
+        "session_id": cart["session_id"],
+        "version": cart.get("version", 0),
+        "total_items": cart["total_items"],
+        "total_amount": cart["total_amount"],
+        "updated_at": cart["updated_at"],
+        "items": [lines[key] for key in keys if key in lines],
+        "removed": [
+            {"product_id": before[key]["product_id"], "size": before[key]["size"]}
+            for key in keys if key not in lines and key in before
+        ]
+    }
+
+def changed_line_keys(before: dict, after: dict) -> List[str]:
+    return [key for key in {**before, **after} if before.get(key) != after.get(key)]
+
+def cleared_cart_update() -> dict:
+    return {
+        "$set": {
+            "lines": {},
+            "total_items": 0,
+            "total_amount": 0,
+            "updated_at": datetime.utcnow()
+        },
+        "$unset": {"items": ""},
+        "$inc": {"version": 1}
+    }
+
+def cart_totals(lines: dict) -> dict:
+    return {
+        "total_items": sum(line["quantity"] for line in lines.values()),
+        "total_amount": sum(line["total_price"] for line in lines.values())
+    }
+
+def add_cart_line(lines: dict, cart_item: CartItem) -> dict:
+    """Add a line, or increase the quantity of an existing one (see add_line_pipeline)"""
+    key = line_key(cart_item.product_id, cart_item.size)
+    if key in lines:
+        quantity = lines[key]["quantity"] + cart_item.quantity
+        lines[key]["quantity"] = quantity
+        lines[key]["total_price"] = quantity * cart_item.size_price
+    else:
+        lines[key] = cart_item.dict()
+    return lines
+
+# Cart update pipelines
+# Aggregation-pipeline updates let Mongo merge a line and recompute totals from
+# the stored lines in one atomic step; values are wrapped in $literal so user
+# input can never be read as a field path or operator.
+def line_key_expression(line: str) -> dict:
+    """Aggregation equivalent of line_key() for a line variable"""
+    key = {"$concat": [f"$${line}.product_id", "|", f"$${line}.size"]}
+    for find, replacement in (("%", "%25"), (".", "%2E"), ("$", "%24")):
+        key = {"$replaceAll": {"input": key, "find": {"$literal": find}, "replacement": replacement}}
+    return key
+
+def migrate_lines_stages() -> list:
+    """Build ``lines`` from a legacy ``items`` array when the cart has no map yet"""
+    return [
+        {"$set": {"lines": {"$ifNull": ["$lines", {"$arrayToObject": {"$map": {
+            "input": {"$ifNull": ["$items", []]},
+            "as": "line",
+            "in": {"k": line_key_expression("line"), "v": "$$line"}
+        }}}]}}},
+        {"$unset": "items"}
+    ]
+
+def cart_totals_stage() -> dict:
+    now = datetime.utcnow()
+    lines = {"$objectToArray": "$lines"}
+    return {"$set": {
+        "total_items": {"$sum": {"$map": {"input": lines, "as": "line", "in": "$$line.v.quantity"}}},
+        "total_amount": {"$sum": {"$map": {"input": lines, "as": "line", "in": "$$line.v.total_price"}}},
+        "updated_at": now,
+        "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+        # Filled in only when the update created the cart
+        "id": {"$ifNull": ["$id", str(uuid.uuid4())]},
+        "created_at": {"$ifNull": ["$created_at", now]}
+    }}
+
+def add_line_pipeline(cart_item: CartItem) -> list:
+    """Pipeline adding a cart line, or increasing the quantity of an existing one"""
+    key = line_key(cart_item.product_id, cart_item.size)
+    existing = f"$lines.{key}"
+    new_quantity = {"$add": [f"{existing}.quantity", cart_item.quantity]}
+    return [
+        *migrate_lines_stages(),
+        {"$set": {f"lines.{key}": {"$cond": [
+            {"$eq": [{"$type": existing}, "object"]},
+            {"$mergeObjects": [existing, {
+                "quantity": new_quantity,
+                "total_price": {"$multiply": [new_quantity, {"$literal": cart_item.size_price}]}
+            }]},
+            {"$literal": cart_item.dict()}
+        ]}}},
+        cart_totals_stage()
+    ]
+
+# Write-behind cart store
+class CartEngine:
+    """Keeps hot carts in memory and writes dirty ones back to Mongo in batches.
+
+    Carts are evicted least recently used first; a dirty cart is flushed
+    before it is dropped. Mutations to the same cart between two flushes are
+    coalesced into a single replace.
+    """
+
+    def __init__(self, collection, capacity: int, flush_interval: float, durability: str):
+        self.collection = collection
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self._carts = OrderedDict()  # session_id -> stored cart document
+        self._dirty = set()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    async def load(self, session_id: str) -> Optional[dict]:
+        cart = self._carts.get(session_id)
+        if cart is None:
+            cart = await self.collection.find_one({"session_id": session_id})
+            if cart is None:
+                return None
+            # Make room before caching it, so reads keep the cache bounded too
+            # and nothing is awaited between caching and returning the cart
+            await self._evict(self.capacity - 1)
+            # Another request may have loaded or changed it while we waited
+            cart = self._carts.setdefault(session_id, {**cart, "lines": cart_lines(cart)})
+        self._carts.move_to_end(session_id)
+        return cart
+
+    async def mutate(self, session_id: str, mutate, create: bool = False) -> Optional[dict]:
+        """Apply ``mutate(lines) -> lines`` in memory; None if the cart doesn't exist"""
+        cart = await self.load(session_id)
+        if cart is None:
+            if not create:
+                return None
+            cart = self._carts.setdefault(session_id, cart_document(Cart(session_id=session_id)))
+        
+        # Documents are replaced rather than changed in place so a flush in
+        # progress keeps writing a consistent snapshot
+        lines = mutate({key: dict(line) for key, line in cart["lines"].items()})
+        cart = {
+            **{field: value for field, value in cart.items() if field != "items"},
+            "lines": lines,
+            **cart_totals(lines),
+            "updated_at": datetime.utcnow(),
+            "version": cart.get("version", 0) + 1
+        }
+        self._carts[session_id] = cart
+        self._carts.move_to_end(session_id)
+        self._dirty.add(session_id)
+        
+        if self.durability == "sync":
+            await self.flush([session_id])
+        await self._evict()
+        return cart
+
+    async def flush(self, session_ids: Optional[List[str]] = None):
+        """Write dirty carts (all of them, or the given ones) in one bulk_write"""
+        async with self._flush_lock:
+            ids = [sid for sid in (self._dirty if session_ids is None else session_ids) if sid in self._dirty]
+            if not ids:
+                return
+            # Carts changed while the write is in flight are marked dirty again
+            self._dirty.difference_update(ids)
+            operations = [
+                ReplaceOne(
+                    {"session_id": sid},
+                    {field: value for field, value in self._carts[sid].items() if field != "_id"},
+                    upsert=True
+                )
+                for sid in ids
+            ]
+            try:
+                await self.collection.bulk_write(operations, ordered=False)
+            except Exception:
+                self._dirty.update(ids)
+                raise
+            metrics["cart_flushes"] += 1
+            metrics["cart_flushed_carts"] += len(ids)
+
+    async def _evict(self, capacity: Optional[int] = None):
+        capacity = self.capacity if capacity is None else capacity
+        while len(self._carts) > max(capacity, 0):
+            session_id, cart = next(iter(self._carts.items()))
+            if session_id in self._dirty:
+                await self.flush([session_id])
+                # Touched while flushing: it is no longer the eviction candidate
+                if self._carts.get(session_id) is not cart:
+                    continue
+            self._carts.pop(session_id, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Cart flush failed: {e}")
+
+    def start(self):
+        if self.durability != "sync":
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+cart_engine = (
+    CartEngine(db.carts, CART_CACHE_SIZE, CART_FLUSH_INTERVAL, CART_DURABILITY)
+    if CART_STORE == "memory" else None
+)
+
+# Optimistic cart updates
+async def update_cart_lines(session_id: str, mutate, create: bool = False) -> Tuple[dict, dict]:
+    """Apply ``mutate(lines) -> lines`` to a cart with compare-and-swap on its version.
+
+    Only lines that changed are written, each by its own path. A concurrent
+    write makes the swap miss; the cart is then re-read and the mutation
+    re-applied, up to CART_CAS_ATTEMPTS times. With ``create`` a missing cart
+    is started empty instead of raising 404.
+
+    Returns ``(lines_before, cart)``. A successful swap means the stored cart
+    is exactly what was written, so it is assembled here rather than read back.
+    """
+    if cart_engine is not None:
+        before = {}
+        
+        def tracked(lines):
+            before.clear()
+            before.update({key: dict(line) for key, line in lines.items()})
+            return mutate(lines)
+        
+        cart = await cart_engine.mutate(session_id, tracked, create=create)
+        if cart is None:
+            raise HTTPException(status_code=404, detail="Cart not found")
+        return before, cart
+    
+    for attempt in range(CART_CAS_ATTEMPTS):
+        cart = await db.carts.find_one({"session_id": session_id})
+        if not cart:
+            if not create:
+                raise HTTPException(status_code=404, detail="Cart not found")
+            cart = {}
+        
+        old_lines = cart_lines(cart)
+        lines = mutate({key: dict(line) for key, line in old_lines.items()})
+        update = {"$set": {
+            **cart_totals(lines),
+            "updated_at": datetime.utcnow(),
+            "version": cart.get("version", 0) + 1
+        }}
+        if "lines" in cart:
+            for key, line in lines.items():
+                if old_lines.get(key) != line:
+                    update["$set"][f"lines.{key}"] = line
+            removed = [key for key in old_lines if key not in lines]
+            if removed:
+                update["$unset"] = {f"lines.{key}": "" for key in removed}
+        else:
+            update["$set"]["lines"] = lines
+            update["$unset"] = {"items": ""}
+        if not cart:
+            update["$setOnInsert"] = {"id": str(uuid.uuid4()), "created_at": datetime.utcnow()}
+        
+        try:
+            result = await db.carts.update_one(
+                # None also matches carts written before versioning existed
+                {"session_id": session_id, "version": cart.get("version")},
+                update,
+                upsert=not cart
+            )
+        except DuplicateKeyError:
+            # Another request created the cart first
+            result = None
+        if result is not None and (result.matched_count or result.upserted_id is not None):
+            updated_cart = {
+                **{field: value for field, value in cart.items() if field not in ("items", "lines")},
+                **update.get("$setOnInsert", {}),
+                **{field: value for field, value in update["$set"].items() if not field.startswith("lines")},
+                "session_id": session_id,
+                "lines": lines
+            }
+            if result.upserted_id is not None:
+                updated_cart["_id"] = result.upserted_id
+            return old_lines, updated_cart
+        metrics["cart_cas_retries"] += 1
+    
+    metrics["cart_cas_conflicts"] += 1
+    raise HTTPException(status_code=409, detail="Cart was modified concurrently, please retry")
+
+# Stock reservations
+# Every unit a cart line holds is taken out of size_options[].stock by one
+# conditional $inc that only matches while enough stock is left, so concurrent
+# buyers can never take the same unit. The hold record remembers how much to
+# give back when the line shrinks, the hold expires or the cart is cleared;
+# placing an order converts the holds instead.
+def hold_expiry() -> datetime:
+    return datetime.utcnow() + timedelta(minutes=RESERVATION_HOLD_MINUTES)
+
+async def take_stock(product_id: str, size: str, quantity: int, session=None) -> bool:
+    result = await db.products.update_one(
+        {"id": product_id, "size_options": {"$elemMatch": {"size": size, "stock": {"$gte": quantity}}}},
+        {"$inc": {"size_options.$.stock": -quantity, "total_size_stock": -quantity}},
+        session=session
+    )
+    return result.modified_count == 1
+
+async def return_stock(product_id: str, size: str, quantity: int, session=None):
+    await db.products.update_one(
+        {"id": product_id, "size_options.size": size},
+        {"$inc": {"size_options.$.stock": quantity, "total_size_stock": quantity}},
+        session=session
+    )
+
+async def held_stock(product_ids: Optional[List[str]] = None) -> dict:
+    """Units currently held by carts, keyed by (product_id, size)"""
+    match = {"status": "held"}
+    if product_ids is not None:
+        match["product_id"] = {"$in": list(product_ids)}
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": {"product_id": "$product_id", "size": "$size"}, "quantity": {"$sum": "$quantity"}}}
+    ]
+    return {
+        (group["_id"]["product_id"], group["_id"]["size"]): group["quantity"]
+        async for group in db.stock_reservations.aggregate(pipeline)
+    }
+
+# Stored stock excludes units held by carts, while imports, exports and
+# on_hand product updates work with stock on hand; these convert between the two
+def without_holds(product_id: str, size_options: List[dict], held: dict) -> List[dict]:
+    return [{**option, "stock": option.get("stock", 0) - held.get((product_id, option["size"]), 0)} for option in size_options]
+
+def with_holds(product_id: str, size_options: List[dict], held: dict) -> List[dict]:
+    return [{**option, "stock": option.get("stock", 0) + held.get((product_id, option["size"]), 0)} for option in size_options]
+
+async def hold_stock(session_id: str, product_id: str, size: str, quantity: int) -> int:
+    """Take ``quantity`` more units for a cart line, raising 400 if they aren't available.
+
+    Returns the line's total hold afterwards.
+    """
+    if not await take_stock(product_id, size, quantity):
+        raise HTTPException(status_code=400, detail="Not enough stock")
+    line_filter = {"session_id": session_id, "product_id": product_id, "size": size, "status": "held"}
+    try:
+        now = datetime.utcnow()
+        update = {
+            "$inc": {"quantity": quantity},
+            "$set": {"expires_at": hold_expiry(), "updated_at": now},
+            "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": now}
+        }
+        try:
+            hold = await db.stock_reservations.find_one_and_update(
+                line_filter, update, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # A concurrent first add for the line inserted its hold; add to that one
+            hold = await db.stock_reservations.find_one_and_update(
+                line_filter, update, return_document=ReturnDocument.AFTER
+            )
+            if hold is None:
+                raise HTTPException(status_code=409, detail="Cart was modified concurrently, please retry")
+    except Exception:
+        await return_stock(product_id, size, quantity)
+        raise
+    return hold["quantity"]
+
+async def set_hold(session_id: str, product_id: str, size: str, quantity: int) -> int:
+    """Make a cart line's hold exactly ``quantity`` units; returns the previous hold.
+
+    The hold record is swapped with a compare-and-swap on its quantity, so
+    concurrent changes to the same line retry instead of double counting.
+    """
+    line_filter = {"session_id": session_id, "product_id": product_id, "size": size, "status": "held"}
+    for attempt in range(CART_CAS_ATTEMPTS):
+        hold = await db.stock_reservations.find_one(line_filter)
+        held = hold["quantity"] if hold else 0
+        delta = quantity - held
+        if delta == 0:
+            if hold:
+                await db.stock_reservations.update_one({"id": hold["id"]}, {"$set": {"expires_at": hold_expiry()}})
+            return held
+        if delta > 0 and not await take_stock(product_id, size, delta):
+            raise HTTPException(status_code=400, detail="Not enough stock")
+        
+        now = datetime.utcnow()
+        if hold is None:
+            try:
+                await db.stock_reservations.insert_one(StockReservation(
+                    session_id=session_id, product_id=product_id, size=size,
+                    quantity=quantity, expires_at=hold_expiry()
+                ).dict())
+                swapped = True
+            except DuplicateKeyError:
+                swapped = False
+        elif quantity == 0:
+            result = await db.stock_reservations.update_one(
+                {"id": hold["id"], "status": "held", "quantity": held},
+                {"$set": {"status": "released", "updated_at": now, "finished_at": now}}
+            )
+            swapped = result.modified_count == 1
+        else:
+            result = await db.stock_reservations.update_one(
+                {"id": hold["id"], "status": "held", "quantity": held},
+                {"$set": {"quantity": quantity, "expires_at": hold_expiry(), "updated_at": now}}
+            )
+            swapped = result.modified_count == 1
+        
+        if swapped:
+            if delta < 0:
+                await return_stock(product_id, size, -delta)
+            return held
+        # Lost the race for this line: undo and look again
+        if delta > 0:
+            await return_stock(product_id, size, delta)
+    
+    raise HTTPException(status_code=409, detail="Cart was modified concurrently, please retry")
+
+async def release_holds(query: dict, limit: Optional[int] = None) -> int:
+    """Release live holds matching ``query`` one at a time, returning their stock"""
+    released = 0
+    while limit is None or released < limit:
+        # Claiming the hold first means each one is given back exactly once
+        now = datetime.utcnow()
+        hold = await db.stock_reservations.find_one_and_update(
+            {**query, "status": "held"},
+            {"$set": {"status": "released", "updated_at": now, "finished_at": now}}
+        )
+        if hold is None:
+            break
+        await return_stock(hold["product_id"], hold["size"], hold["quantity"])
+        released += 1
+    return released
+
+async def sweep_expired_holds():
+    """Periodically give back stock held by carts that went quiet"""
+    while True:
+        await asyncio.sleep(RESERVATION_SWEEP_INTERVAL)
+        try:
+            released = await release_holds({"expires_at": {"$lte": datetime.utcnow()}}, limit=1000)
+            metrics["reservations_expired"] += released
+            if released:
+                logger.info(f"Released {released} expired stock holds")
+        except Exception as e:
+            logger.error(f"Stock hold sweep failed: {e}")
+
+async def load_cart(session_id: str) -> Optional[dict]:
+    if cart_engine is not None:
+        return await cart_engine.load(session_id)
+    return await db.carts.find_one({"session_id": session_id})
+
+async def reprice_cart(session_id: str) -> Tuple[Optional[dict], list, list]:
+    """Revalidate every line of a cart against current prices and stock.
+
+    Products are loaded in one batch (from the snapshot cache or a single $in
+    query) and only lines that changed are written back, through the usual
+    compare-and-swap. Returns the cart, the price changes applied and the
+    lines whose stock could not be reserved (see recheck_holds).
+    """
+    cart = await load_cart(session_id)
+    if not cart:
+        return None, [], []
+    
+    product_ids = {line["product_id"] for line in cart_lines(cart).values()}
+    products = await get_product_snapshots(product_ids)
+    lines, changes = reprice_lines({key: dict(line) for key, line in cart_lines(cart).items()}, products, product_ids)
+    if lines != cart_lines(cart):
+        applied = {}
+        
+        def apply_prices(lines):
+            # Lines added concurrently aren't in product_ids and are left alone
+            lines, applied["changes"] = reprice_lines(lines, products, product_ids)
+            return lines
+        
+        before, cart = await update_cart_lines(session_id, apply_prices)
+        changes = applied["changes"]
+        for change in changes:
+            if change["new_price"] is None:
+                await release_holds({"session_id": session_id, "product_id": change["product_id"], "size": change["size"]})
+    
+    return cart, changes, await recheck_holds(session_id, cart_lines(cart))
+
+async def recheck_holds(session_id: str, lines: dict) -> list:
+    """Make sure every cart line is still covered by a live hold.
+
+    Holds expire while their cart lines stay, so a line can outlive its
+    reservation. Lines with a missing or short hold try to reserve again;
+    the ones that can't are returned with the quantity still reserved.
+    """
+    held = {}
+    async for hold in db.stock_reservations.find(
+        {"session_id": session_id, "status": "held"}, {"_id": 0, "product_id": 1, "size": 1, "quantity": 1}
+    ):
+        held[line_key(hold["product_id"], hold["size"])] = hold["quantity"]
+    
+    stock_issues = []
+    for key, line in lines.items():
+        reserved = held.get(key, 0)
+        if reserved >= line["quantity"]:
+            continue
+        try:
+            await set_hold(session_id, line["product_id"], line["size"], line["quantity"])
+        except HTTPException:
+            stock_issues.append({
+                "product_id": line["product_id"],
+                "size": line["size"],
+                "quantity": line["quantity"],
+                "reserved": reserved
+            })
+    return stock_issues
+
+async def clear_cart_lines(session_id: str):
+    """Empty a cart if it exists"""
+    if cart_engine is not None:
+        await cart_engine.mutate(session_id, lambda lines: {})
+    else:
+        await db.carts.update_one({"session_id": session_id}, cleared_cart_update())
+
+# Order numbers
+def luhn_check_digit(digits: str) -> str:
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if position % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return str((10 - total % 10) % 10)
+
+def is_valid_order_number(order_number: str) -> bool:
+    """False only for numbers in the allocator's format whose check digit is wrong"""
+    digits = order_number[3:]
+    # Only the exact allocator length is checked: numbers issued before the
+    # allocator were a date and 8 hex characters (16 digits when all decimal),
+    # and sequences past 99999 are longer
+    if not (order_number.startswith("KTH") and digits.isdigit() and len(digits) == 14):
+        return True
+    return luhn_check_digit(digits[:-1]) == digits[-1]
+
+class OrderNumberAllocator:
+    """Hands out order numbers KTH{YYYYMMDD}{sequence:05d}{check digit}.
+
+    Sequences restart every day and come from a per-day counter document.
+    Each $inc reserves a whole block, so most orders get their number without
+    a round trip; numbers left in a block when the process stops are skipped.
+    """
+
+    def __init__(self, collection, block_size: int):
+        self.collection = collection
+        self.block_size = block_size
+        self._day = None
+        self._next = 0
+        self._end = 0  # last sequence of the reserved block
+        self._lock = asyncio.Lock()
+
+    async def allocate(self) -> str:
+        async with self._lock:
+            day = datetime.now().strftime('%Y%m%d')
+            if day != self._day or self._next > self._end:
+                counter = await self.collection.find_one_and_update(
+                    {"_id": day},
+                    {"$inc": {"seq": self.block_size}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                self._day = day
+                self._end = counter["seq"]
+                self._next = self._end - self.block_size + 1
+            sequence = self._next
+            self._next += 1
+        digits = f"{day}{sequence:05d}"
+        return f"KTH{digits}{luhn_check_digit(digits)}"
+
+order_numbers = OrderNumberAllocator(db.order_counters, ORDER_NUMBER_BLOCK)
+
+# Post-order jobs
+# Work that follows an order (confirmation, inventory sync, analytics) is
+# written to the order_jobs outbox in the same transaction as the order, then
+# run by a small pool of workers. A job that fails is retried with exponential
+# backoff and dead-lettered after JOB_MAX_ATTEMPTS. Jobs claimed by a process
+# that died become claimable again when their lease runs out.
+ORDER_JOB_TYPES = ["order_confirmation", "inventory_sync", "analytics"]
+
+class LoggingSink:
+    """Default sink: writes each message to the log"""
+
+    async def send(self, channel: str, message: dict):
+        logger.info(f"[{channel}] {json.dumps(message, default=str, ensure_ascii=False)}")
+
+class MemorySink:
+    """Keeps messages in process, for local runs and tests"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, channel: str, message: dict):
+        self.messages.append((channel, message))
+
+async def send_order_confirmation(order: dict, sink):
+    await sink.send("order_confirmation", {
+        "to": order["customer_info"]["email"],
+        "name": order["customer_info"]["full_name"],
+        "order_number": order["order_number"],
+        "total_amount": order["total_amount"],
+        "payment_method": order["payment_method"]
+    })
+
+async def sync_order_inventory(order: dict, sink):
+    # Stock was taken at checkout; cached listings and snapshots still show the old numbers
+    for product_id in {item["product_id"] for item in order["items"]}:
+        invalidate_catalog(product_id)
+    await sink.send("inventory_sync", {
+        "order_number": order["order_number"],
+        "items": [{"product_id": item["product_id"], "size": item["size"], "quantity": item["quantity"]} for item in order["items"]]
+    })
+
+async def record_order_analytics(order: dict, sink):
+    await sink.send("analytics", {
+        "event": "order_created",
+        "order_number": order["order_number"],
+        "items": sum(item["quantity"] for item in order["items"]),
+        "subtotal": order["subtotal"],
+        "total_amount": order["total_amount"],
+        "payment_method": order["payment_method"],
+        "created_at": order["created_at"]
+    })
+
+ORDER_JOB_HANDLERS = {
+    "order_confirmation": send_order_confirmation,
+    "inventory_sync": sync_order_inventory,
+    "analytics": record_order_analytics,
+}
+
+def order_jobs(order_id: str) -> List[dict]:
+    now = datetime.utcnow()
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "type": job_type,
+            "order_id": order_id,
+            "status": "pending",
+            "attempts": 0,
+            "run_at": now,
+            "created_at": now,
+            "updated_at": now
+        }
+        for job_type in ORDER_JOB_TYPES
+    ]
+
+class JobQueue:
+    """Runs outbox jobs with at most ``workers`` at a time"""
+
+    def __init__(self, collection, sink, workers: int):
+        self.collection = collection
+        self.sink = sink
+        self.workers = workers
+        self._wake = asyncio.Event()
+        self._tasks = []
+
+    def notify(self):
+        """Wake idle workers, e.g. right after jobs were enqueued"""
+        self._wake.set()
+
+    async def claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "run_at": {"$lte": now}},
+                {"status": "running", "locked_until": {"$lte": now}}
+            ]},
+            {
+                "$set": {"status": "running", "locked_until": now + timedelta(seconds=JOB_LEASE_SECONDS), "updated_at": now},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def run(self, job: dict):
+        try:
+            order = await db.orders.find_one({"id": job["order_id"]})
+            if order is None:
+                raise LookupError(f"Order not found: {job['order_id']}")
+            await ORDER_JOB_HANDLERS[job["type"]](order, self.sink)
+        except Exception as e:
+            now = datetime.utcnow()
+            if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                metrics["jobs_dead"] += 1
+                logger.error(f"Job {job['type']} for order {job['order_id']} dead-lettered: {e}")
+                update = {"status": "dead", "last_error": str(e), "updated_at": now}
+            else:
+                metrics["jobs_retried"] += 1
+                delay = JOB_RETRY_DELAY * 2 ** (job["attempts"] - 1)
+                update = {"status": "pending", "run_at": now + timedelta(seconds=delay), "last_error": str(e), "updated_at": now}
+            await self.collection.update_one({"id": job["id"]}, {"$set": update, "$unset": {"locked_until": ""}})
+            return
+        
+        metrics["jobs_done"] += 1
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"id": job["id"]},
+            {"$set": {"status": "done", "finished_at": now, "updated_at": now}, "$unset": {"locked_until": ""}}
+        )
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self.claim()
+            except Exception as e:
+                logger.error(f"Claiming a job failed: {e}")
+                job = None
+            if job is not None:
+                try:
+                    await self.run(job)
+                except Exception as e:
+                    # Usually a failed status write; the job's lease runs out
+                    # and it is claimed again
+                    logger.error(f"Job {job['type']} for order {job['order_id']} could not be recorded: {e}")
+                continue
+            # Nothing due: sleep until notified or the next poll
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+job_queue = JobQueue(db.order_jobs, MemorySink() if JOB_SINK == "memory" else LoggingSink(), JOB_WORKERS)
+
+# Checkout
+# An order is priced from the catalog, never from the client, and its stock
+# changes, insert and cart clear commit together. Multi-document transactions
+# need a replica set or sharded cluster; on a standalone server the same steps
+# run one by one and are undone in reverse if a later one fails.
+checkout_state = {"transactions": None}
+
+async def supports_transactions() -> bool:
+    if checkout_state["transactions"] is None:
+        try:
+            hello = await client.admin.command("hello")
+            checkout_state["transactions"] = "setName" in hello or hello.get("msg") == "isdbgrid"
+        except Exception:
+            checkout_state["transactions"] = False
+        logger.info(f"Checkout transactions {'enabled' if checkout_state['transactions'] else 'unavailable, using compensation'}")
+    return checkout_state["transactions"]
+
+def requested_lines(items: list) -> List[tuple]:
+    """(product_id, size, quantity) for each client item; prices sent along are ignored"""
+    lines = []
+    for item in items:
+        if not isinstance(item, dict) or "product_id" not in item or "size" not in item:
+            raise HTTPException(status_code=400, detail="Each item needs a product_id and size")
+        quantity = item.get("quantity")
+        if not isinstance(quantity, int) or quantity < 1:
+            raise HTTPException(status_code=400, detail="Quantity must be a positive integer")
+        lines.append((item["product_id"], item["size"], quantity))
+    return lines
+
+async def place_order(order_data: dict, order_number: str, lines: List[tuple], cart: Optional[dict], idempotency_key: Optional[str] = None, session=None, undo: Optional[list] = None) -> Order:
+    """Price ``lines``, take their stock, insert the order and clear the cart.
+
+    With a transaction ``session`` everything commits or aborts together.
+    Without one, ``undo`` collects the compensating steps for what has
+    already been written.
+    """
+    def compensate(step):
+        if undo is not None:
+            undo.append(step)
+    
+    products = {}
+    async for product in db.products.find(
+        {"id": {"$in": list({product_id for product_id, _, _ in lines})}}, SNAPSHOT_PROJECTION, session=session
+    ):
+        products[product["id"]] = product_snapshot(product)
+    
+    session_id = order_data.get("session_id")
+    holds = {}
+    if session_id:
+        async for hold in db.stock_reservations.find({"session_id": session_id, "status": "held"}, session=session):
+            holds[line_key(hold["product_id"], hold["size"])] = hold
+    
+    order = Order(
+        order_number=order_number,
+        customer_info=CustomerInfo(**order_data["customer_info"]),
+        items=[],
+        payment_method=order_data["payment_method"],
+        subtotal=0,
+        total_amount=0
+    )
+    now = datetime.utcnow()
+    for product_id, size, quantity in lines:
+        product = products.get(product_id)
+        if not product or size not in product.sizes:
+            raise HTTPException(status_code=400, detail=f"Product is no longer available: {product_id} / {size}")
+        order.items.append(OrderItem(**product.cart_item(size, quantity).dict()))
+        
+        # Units already held for this cart line are sold as they are
+        hold = holds.pop(line_key(product_id, size), None)
+        held = 0
+        if hold:
+            result = await db.stock_reservations.update_one(
+                {"id": hold["id"], "status": "held", "quantity": hold["quantity"]},
+                {"$set": {"status": "converted", "order_id": order.id, "updated_at": now, "finished_at": now}},
+                session=session
+            )
+            if result.modified_count == 1:
+                held = hold["quantity"]
+                compensate(lambda hold=hold: db.stock_reservations.update_one(
+                    {"id": hold["id"]}, {"$set": {"status": "held", "order_id": None}, "$unset": {"finished_at": ""}}
+                ))
+        
+        if quantity > held:
+            if not await take_stock(product_id, size, quantity - held, session=session):
+                raise HTTPException(status_code=400, detail=f"Not enough stock: {product.name} / {size}")
+            compensate(lambda product_id=product_id, size=size, extra=quantity - held: return_stock(product_id, size, extra))
+        elif held > quantity:
+            await return_stock(product_id, size, held - quantity, session=session)
+            compensate(lambda product_id=product_id, size=size, surplus=held - quantity: take_stock(product_id, size, surplus))
+    
+    order.subtotal = sum(item.total_price for item in order.items)
+    order.shipping_fee = 30000 if order.payment_method == "cod" else 0  # COD fee
+    order.total_amount = order.subtotal + order.shipping_fee - order.discount
+    
+    document = order.dict()
+    if idempotency_key:
+        document["idempotency_key"] = idempotency_key
+    await db.orders.insert_one(document, session=session)
+    compensate(lambda: db.orders.delete_one({"id": order.id}))
+    await db.order_jobs.insert_many(order_jobs(order.id), session=session)
+    compensate(lambda: db.order_jobs.delete_many({"order_id": order.id}))
+    
+    if cart is not None and cart_engine is None:
+        # The version check makes sure the order holds exactly what was in the cart
+        result = await db.carts.update_one(
+            {"session_id": session_id, "version": cart.get("version")},
+            cleared_cart_update(),
+            session=session
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=409, detail="Cart was modified during checkout, please retry")
+    return order
+
+async def checkout(order_data: dict, lines: List[tuple], cart: Optional[dict], idempotency_key: Optional[str] = None) -> Order:
+    # Allocated once, outside the transaction, so retries keep the same number
+    order_number = await order_numbers.allocate()
+    if await supports_transactions():
+        async with await client.start_session() as session:
+            # with_transaction retries the whole callback on transient errors,
+            # such as a write conflict with another buyer of the same size
+            order = await session.with_transaction(
+                lambda session: place_order(order_data, order_number, lines, cart, idempotency_key, session=session)
+            )
+    else:
+        undo = []
+        try:
+            order = await place_order(order_data, order_number, lines, cart, idempotency_key, undo=undo)
+        except Exception:
+            for step in reversed(undo):
+                try:
+                    await step()
+                except Exception as e:
+                    logger.error(f"Checkout compensation step failed: {e}")
+            raise
+    
+    if cart is not None and cart_engine is not None:
+        await clear_cart_lines(order_data["session_id"])
+    job_queue.notify()
+    return order
+
+# Idempotency keys
+# The first request with a key claims it by inserting an in_progress record
+# (the unique index lets exactly one insert win) and stores its response when
+# done. Retries with the same key get that response back; duplicates arriving
+# while it is still running poll until it finishes. A failed request releases
+# the key so the client can try again.
+# Claims carry a lease: one left behind by a crashed process is taken over
+# once it runs out. Orders store their key too, so a request that placed its
+# order but never completed the record is answered from the order itself.
+def request_hash(payload) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+async def claim_idempotency_key(scope: str, key: str, payload_hash: str) -> Tuple[Optional[dict], Optional[str]]:
+    """Claim ``key`` for this request.
+
+    Returns ``(None, claim_id)`` when claimed, or ``(record, None)`` with the
+    completed record of an earlier request.
+    """
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        claim_id = str(uuid.uuid4())
+        now = datetime.utcnow()
+        lease = now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+        try:
+            await db.idempotency_keys.insert_one({
+                "scope": scope,
+                "key": key,
+                "request_hash": payload_hash,
+                "status": "in_progress",
+                "claim_id": claim_id,
+                "locked_until": lease,
+                "created_at": now
+            })
+            return None, claim_id
+        except DuplicateKeyError:
+            record = await db.idempotency_keys.find_one({"scope": scope, "key": key})
+        
+        if record is not None:
+            if record["request_hash"] != payload_hash:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+            if record["status"] == "completed":
+                return record, None
+            if record.get("locked_until") is None or record["locked_until"] <= now:
+                # The holder is gone; whoever swaps the lease first takes over
+                result = await db.idempotency_keys.update_one(
+                    {"_id": record["_id"], "status": "in_progress", "claim_id": record.get("claim_id")},
+                    {"$set": {"claim_id": claim_id, "locked_until": lease}}
+                )
+                if result.modified_count == 1:
+                    return None, claim_id
+                continue
+            if time.monotonic() >= deadline:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+        # No record means the original failed and released the key; claim it again
+
+async def complete_idempotency_key(scope: str, key: str, claim_id: str, response: dict):
+    await db.idempotency_keys.update_one(
+        {"scope": scope, "key": key, "claim_id": claim_id},
+        {"$set": {"status": "completed", "response": response}, "$unset": {"locked_until": ""}}
+    )
+
+async def release_idempotency_key(scope: str, key: str, claim_id: str):
+    await db.idempotency_keys.delete_one({"scope": scope, "key": key, "status": "in_progress", "claim_id": claim_id})
+
 # Add your routes to the router instead of directly to app
 @api_router.get("/")
 async def root():
     return {"message": "Khang Trầm Hương API"}
 
-@api_router.get("/products", response_model=List[Product])
-async def get_products(featured: Optional[bool] = None, category: Optional[str] = None):
-    """Get all products with optional filtering"""
+@api_router.get("/products", response_model=None, responses={200: {"model": Union[List[Product], ProductPage]}})
+async def get_products(
+    request: Request,
+    featured: Optional[bool] = None,
+    category: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    in_stock: Optional[bool] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
+    ids: Optional[str] = None
+):
+    """Get products with optional filtering.
+
+    ``min_price``/``max_price`` match products with any size priced in range
+    (products without sizes by their ``price``) and ``in_stock`` filters on the
+    total stock across sizes.
+    Without ``limit``/``cursor`` the listing is returned as a plain list of at
+    most MAX_LIST_SIZE products; if more match, ``X-Next-Cursor`` carries the
+    cursor to page through the rest.
+    With either of them a page of at most ``limit`` products is returned together
+    with a ``next_cursor`` to fetch the following page.
+    ``view=card`` or ``fields=a,b,c`` trims each product to the given fields.
+    Responses carry an ETag; a matching ``If-None-Match`` gets 304.
+    ``ids=a,b,c`` instead resolves exactly those products (see ``lookup_products``).
+    """
+    paginated = limit is not None or cursor is not None
+    selected = product_fields(fields, view)
+    if ids is not None:
+        return await lookup_products([product_id.strip() for product_id in ids.split(",") if product_id.strip()], selected)
+    
+    projection = product_projection(selected)
+    cache_key = ("products", featured, category, min_price, max_price, in_stock, limit, cursor, tuple(selected or ()))
+    cached = catalog_cache.get(cache_key)
+    if cached is not None:
+        return send_encoded(request, cached)
+    
     query = {}
     if featured is not None:
         query["featured"] = featured
     if category:
         query["category"] = category
+    # The derived price range narrows candidates through the index (ranges
+    # overlap when the cheapest size is under the max and the dearest over the
+    # min); $elemMatch then requires one size priced inside the range itself.
+    # Products without sizes are priced at ``price``, as in derived_fields
+    if min_price is not None or max_price is not None:
+        size_price = {}
+        if max_price is not None:
+            query["min_size_price"] = {"$lte": max_price}
+            size_price["$lte"] = max_price
+        if min_price is not None:
+            query["max_size_price"] = {"$gte": min_price}
+            size_price["$gte"] = min_price
+        query["$or"] = [
+            {"size_options": {"$elemMatch": {"price": size_price}}},
+            {"size_options.0": {"$exists": False}, "price": size_price}
+        ]
+    if in_stock is not None:
+        query["total_size_stock"] = {"$gt": 0} if in_stock else {"$lte": 0}
+    
+    generation = catalog_cache.generation
+    if paginated:
+        docs, next_cursor = await fetch_page(db.products, query, limit or MAX_PAGE_SIZE, cursor, projection)
+        encoded = encode_response({"items": [render_product(doc, selected) for doc in docs], "next_cursor": next_cursor})
+    else:
+        docs, next_cursor = await fetch_page(db.products, query, MAX_LIST_SIZE, None, projection)
+        encoded = encode_response(
+            [render_product(doc, selected) for doc in docs],
+            {"X-Next-Cursor": next_cursor} if next_cursor else None
+        )
+    catalog_cache.set(cache_key, encoded, generation)
+    return send_encoded(request, encoded)
+
+@api_router.get("/products/search")
+async def search_products(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    page: int = Query(1, ge=1),
+    fields: Optional[str] = None,
+    view: Optional[str] = None
+):
+    """Full-text search over Vietnamese and English names and descriptions.
+
+    Matching ignores diacritics and results are ranked by relevance.
+    """
+    selected = product_fields(fields, view)
+    projection = {**(product_projection(selected) or {}), "score": {"$meta": "textScore"}}
+    docs = await db.products.find(
+        {"$text": {"$search": fold_text(q)}}, projection
+    ).sort([("score", {"$meta": "textScore"}), ("created_at", -1)]).skip((page - 1) * limit).limit(limit + 1).to_list(limit + 1)
+    return {
+        "items": [render_product(doc, selected) for doc in docs[:limit]],
+        "page": page,
+        "limit": limit,
+        "has_more": len(docs) > limit
+    }
+
+@api_router.get("/products/facets")
+async def get_product_facets():
+    """Category, price band and stock counts for storefront filters"""
+    facets = catalog_cache.get(("facets",))
+    if facets is None:
+        generation = catalog_cache.generation
+        facets = await compute_facets()
+        catalog_cache.set(("facets",), facets, generation)
+    return facets
+
+@api_router.post("/products/lookup")
+async def lookup_products_batch(lookup: ProductLookup, fields: Optional[str] = None, view: Optional[str] = None):
+    """Resolve a list of product IDs in one round trip"""
+    return await lookup_products(lookup.ids, product_fields(fields, view))
+
+@api_router.post("/products/import")
+async def import_products(request: Request):
+    """Bulk upsert products from an NDJSON body, one ProductCreate per line.
+
+    Lines carrying an ``id`` create or replace that product; lines without one
+    create a new product. Invalid lines are reported and skipped.
+    """
+    report = {"processed": 0, "inserted": 0, "updated": 0, "failed": 0, "errors": []}
+    operations, line_numbers = [], []
+    try:
+        line_number = 0
+        async for line in iter_lines(request.stream()):
+            line_number += 1
+            if not line.strip():
+                continue
+            report["processed"] += 1
+            try:
+                data = json.loads(line)
+                if not isinstance(data, dict):
+                    raise ValueError("line is not a JSON object")
+                operations.append(import_product(data))
+                line_numbers.append(line_number)
+            except ValidationError as e:
+                report_import_error(report, line_number, "; ".join(
+                    f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+                ))
+            except ValueError as e:
+                report_import_error(report, line_number, str(e))
+            
+            if len(operations) >= IMPORT_BATCH_SIZE:
+                await flush_import_batch(operations, line_numbers, report)
+                operations, line_numbers = [], []
+        
+        if operations:
+            await flush_import_batch(operations, line_numbers, report)
+    finally:
+        invalidate_catalog()
     
-    products = await db.products.find(query).sort("created_at", -1).to_list(1000)
-    return [Product(**product) for product in products]
+    return report
 
-@api_router.get("/products/{product_id}", response_model=Product)
-async def get_product(product_id: str):
+@api_router.get("/products/export")
+async def export_products():
+    """Stream the whole catalog as NDJSON, one product per line.
+
+    Stock is exported as stock on hand (including units held by carts), the
+    same meaning import gives it, so an export can be imported back as is.
+    """
+    held = await held_stock()
+    
+    async def product_lines():
+        async for doc in db.products.find({}).sort(KEYSET_SORT).batch_size(IMPORT_BATCH_SIZE):
+            product = Product(**doc).dict()
+            product["size_options"] = with_holds(product["id"], product["size_options"], held)
+            yield json.dumps(jsonable_encoder(product), ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(product_lines(), media_type="application/x-ndjson")
+
+@api_router.get("/products/{product_id}", response_model=None, responses={200: {"model": Product}})
+async def get_product(request: Request, product_id: str, fields: Optional[str] = None, view: Optional[str] = None):
     """Get a specific product by ID"""
-    product = await db.products.find_one({"id": product_id})
+    selected = product_fields(fields, view)
+    cache_key = ("product", product_id, tuple(selected or ()))
+    cached = catalog_cache.get(cache_key)
+    if cached is not None:
+        return send_encoded(request, cached)
+    
+    generation = catalog_cache.generation
+    product = await db.products.find_one({"id": product_id}, product_projection(selected))
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    return Product(**product)
+    encoded = encode_response(render_product(product, selected))
+    catalog_cache.set(cache_key, encoded, generation)
+    return send_encoded(request, encoded)
 
 @api_router.post("/products", response_model=Product)
 async def create_product(product: ProductCreate):
     """Create a new product"""
     product_dict = product.dict()
     product_obj = Product(**product_dict)
-    await db.products.insert_one(product_obj.dict())
+    await db.products.insert_one(product_document(product_obj))
+    invalidate_catalog(product_obj.id)
     return product_obj
 
 @api_router.put("/products/{product_id}", response_model=Product)
-async def update_product(product_id: str, product_update: ProductUpdate):
-    """Update a product"""
+async def update_product(product_id: str, product_update: ProductUpdate, on_hand: bool = False):
+    """Update a product.
+
+    Size stock means units free to reserve, as GET /products/{id} reports it.
+    With ``on_hand`` it is stock on hand instead, as in export/import: units
+    held by carts are kept reserved and the response reports stock on hand.
+    """
     existing_product = await db.products.find_one({"id": product_id})
     if not existing_product:
         raise HTTPException(status_code=404, detail="Product not found")
     
     update_data = product_update.dict(exclude_unset=True)
     update_data["updated_at"] = datetime.utcnow()
+    held = await held_stock([product_id]) if on_hand else {}
+    if update_data.get("size_options") is not None:
+        update_data["size_options"] = without_holds(product_id, update_data["size_options"], held)
+    update_data.update(derived_fields({**existing_product, **update_data}))
     
     await db.products.update_one({"id": product_id}, {"$set": update_data})
+    invalidate_catalog(product_id)
     
     updated_product = await db.products.find_one({"id": product_id})
+    updated_product["size_options"] = with_holds(product_id, updated_product.get("size_options", []), held)
     return Product(**updated_product)
 
 @api_router.delete("/products/{product_id}")
@@ -201,130 +2045,78 @@ async def delete_product(product_id: str):
     result = await db.products.delete_one({"id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    invalidate_catalog(product_id)
     return {"message": "Product deleted successfully"}
 
 # Cart API endpoints
 @api_router.get("/cart/{session_id}")
-async def get_cart(session_id: str):
-    """Get cart by session ID"""
-    cart = await db.carts.find_one({"session_id": session_id})
-    if not cart:
-        # Create empty cart if not exists
-        new_cart = Cart(session_id=session_id)
-        await db.carts.insert_one(new_cart.dict())
-        return new_cart
+async def get_cart(session_id: str, reprice: bool = False):
+    """Get cart by session ID.
+
+    ``reprice`` first updates lines to current prices and re-reserves stock
+    for lines whose hold expired; ``stock_issues`` lists the lines that no
+    longer have enough stock.
+    """
+    if reprice:
+        cart, changes, stock_issues = await reprice_cart(session_id)
+        if not cart:
+            return {**Cart(session_id=session_id).dict(), "price_changes": [], "stock_issues": []}
+        return {**Cart(**cart_view(cart)).dict(), "price_changes": changes, "stock_issues": stock_issues}
     
-    # Convert MongoDB _id to string
-    if "_id" in cart:
-        cart["_id"] = str(cart["_id"])
+    cart = await load_cart(session_id)
+    if not cart:
+        # Unknown sessions get an empty cart without a write; it is only
+        # stored once something is added
+        return Cart(session_id=session_id)
     
-    return Cart(**cart)
+    return Cart(**cart_view(cart))
 
 @api_router.post("/cart/{session_id}/add")
-async def add_to_cart(session_id: str, item: dict):
-    """Add item to cart"""
+async def add_to_cart(session_id: str, item: dict, view: Optional[str] = None):
+    """Add item to cart; ``view=delta`` returns only the changed line and totals"""
     try:
+        view = cart_view_param(view)
         # Validate required fields
         required_fields = ["product_id", "size", "quantity"]
         for field in required_fields:
             if field not in item:
                 raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
         
-        # Get product details
-        product = await db.products.find_one({"id": item["product_id"]})
+        if not isinstance(item["quantity"], int) or item["quantity"] < 1:
+            raise HTTPException(status_code=400, detail="Quantity must be a positive integer")
+        
+        # Get product pricing, usually from the snapshot cache
+        product = (await get_product_snapshots([item["product_id"]])).get(item["product_id"])
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
         
-        # Find size option
-        size_option = None
-        for size_opt in product.get("size_options", []):
-            if size_opt["size"] == item["size"]:
-                size_option = size_opt
-                break
-        
-        if not size_option:
+        if item["size"] not in product.sizes:
             raise HTTPException(status_code=400, detail="Size not found")
         
-        # Check stock
-        if size_option["stock"] < item["quantity"]:
-            raise HTTPException(status_code=400, detail="Not enough stock")
+        cart_item = product.cart_item(item["size"], item["quantity"])
+        key = line_key(item["product_id"], item["size"])
         
-        # Get or create cart
-        cart = await db.carts.find_one({"session_id": session_id})
-        if not cart:
-            cart = Cart(session_id=session_id).dict()
-            await db.carts.insert_one(cart)
-            cart = await db.carts.find_one({"session_id": session_id})
-        
-        # Create cart item
-        cart_item = CartItem(
-            product_id=item["product_id"],
-            product_name=product["name"],
-            product_image=product["image_url"],
-            size=item["size"],
-            size_price=size_option["price"],
-            original_price=size_option.get("original_price"),
-            quantity=item["quantity"],
-            total_price=size_option["price"] * item["quantity"]
-        )
+        # Reserve the units first; this is also the stock check, since cached
+        # snapshot stock can lag behind released holds
+        held = await hold_stock(session_id, item["product_id"], item["size"], item["quantity"])
+        try:
+            if cart_engine is not None:
+                updated_cart = await cart_engine.mutate(session_id, lambda lines: add_cart_line(lines, cart_item), create=True)
+            else:
+                # Upsert the line and recompute totals in a single atomic update;
+                # a delta only needs the one line back
+                updated_cart = await db.carts.find_one_and_update(
+                    {"session_id": session_id},
+                    add_line_pipeline(cart_item),
+                    projection={**CART_DELTA_PROJECTION, f"lines.{key}": 1} if view == "delta" else None,
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+        except Exception:
+            await set_hold(session_id, item["product_id"], item["size"], held - item["quantity"])
+            raise
         
-        # Check if item already exists in cart
-        existing_item = None
-        for i, cart_item_dict in enumerate(cart.get("items", [])):
-            if (cart_item_dict["product_id"] == item["product_id"] and 
-                cart_item_dict["size"] == item["size"]):
-                existing_item = i
-                break
-        
-        # Prepare update data
-        update_data = {}
-        
-        if existing_item is not None:
-            # Update existing item
-            new_quantity = cart["items"][existing_item]["quantity"] + item["quantity"]
-            new_total_price = new_quantity * size_option["price"]
-            update_data[f"items.{existing_item}.quantity"] = new_quantity
-            update_data[f"items.{existing_item}.total_price"] = new_total_price
-        else:
-            # Add new item
-            update_data["$push"] = {"items": cart_item.dict()}
-        
-        # Calculate new totals
-        items = cart.get("items", []).copy()
-        if existing_item is not None:
-            items[existing_item]["quantity"] += item["quantity"]
-            items[existing_item]["total_price"] = items[existing_item]["quantity"] * size_option["price"]
-        else:
-            items.append(cart_item.dict())
-        
-        total_items = sum(item["quantity"] for item in items)
-        total_amount = sum(item["total_price"] for item in items)
-        
-        # Add totals to update data
-        if "$push" in update_data:
-            update_data["$set"] = {
-                "total_items": total_items,
-                "total_amount": total_amount,
-                "updated_at": datetime.utcnow()
-            }
-        else:
-            update_data["total_items"] = total_items
-            update_data["total_amount"] = total_amount
-            update_data["updated_at"] = datetime.utcnow()
-            update_data = {"$set": update_data}
-        
-        # Update cart in database
-        await db.carts.update_one(
-            {"session_id": session_id},
-            update_data
-        )
-        
-        # Get updated cart
-        updated_cart = await db.carts.find_one({"session_id": session_id})
-        if "_id" in updated_cart:
-            updated_cart["_id"] = str(updated_cart["_id"])
-        
-        return {"message": "Item added to cart", "cart": updated_cart}
+        return {"message": "Item added to cart", "cart": cart_response(updated_cart, view, [key])}
     
     except HTTPException as e:
         # Re-raise HTTP exceptions
@@ -333,125 +2125,132 @@ async def add_to_cart(session_id: str, item: dict):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.put("/cart/{session_id}/update")
-async def update_cart_item(session_id: str, item: dict):
+async def update_cart_item(session_id: str, item: dict, view: Optional[str] = None):
     """Update cart item quantity"""
     try:
-        cart = await db.carts.find_one({"session_id": session_id})
-        if not cart:
-            raise HTTPException(status_code=404, detail="Cart not found")
-        
-        # Find item index
-        item_index = None
-        for i, cart_item in enumerate(cart.get("items", [])):
-            if (cart_item["product_id"] == item["product_id"] and 
-                cart_item["size"] == item["size"]):
-                item_index = i
-                break
-        
-        if item_index is None:
-            raise HTTPException(status_code=404, detail="Item not found in cart")
-        
-        # Prepare update data
-        update_data = {}
-        
-        if item["quantity"] <= 0:
-            # Remove item
-            update_data["$pull"] = {
-                "items": {
-                    "product_id": item["product_id"],
-                    "size": item["size"]
-                }
-            }
-        else:
-            # Update quantity and total price
-            size_price = cart["items"][item_index]["size_price"]
-            update_data["$set"] = {
-                f"items.{item_index}.quantity": item["quantity"],
-                f"items.{item_index}.total_price": size_price * item["quantity"]
-            }
-        
-        # Calculate new totals
-        items = cart.get("items", []).copy()
-        if item["quantity"] <= 0:
-            items = [i for i in items if not (i["product_id"] == item["product_id"] and i["size"] == item["size"])]
-        else:
-            items[item_index]["quantity"] = item["quantity"]
-            items[item_index]["total_price"] = items[item_index]["size_price"] * item["quantity"]
-        
-        total_items = sum(i["quantity"] for i in items)
-        total_amount = sum(i["total_price"] for i in items)
-        
-        # Add totals to update data
-        if "$set" in update_data:
-            update_data["$set"]["total_items"] = total_items
-            update_data["$set"]["total_amount"] = total_amount
-            update_data["$set"]["updated_at"] = datetime.utcnow()
-        else:
-            update_data["$set"] = {
-                "total_items": total_items,
-                "total_amount": total_amount,
-                "updated_at": datetime.utcnow()
-            }
-        
-        # Update cart in database
-        await db.carts.update_one(
-            {"session_id": session_id},
-            update_data
-        )
+        view = cart_view_param(view)
+        key = line_key(item["product_id"], item["size"])
         
-        # Get updated cart
-        updated_cart = await db.carts.find_one({"session_id": session_id})
-        if "_id" in updated_cart:
-            updated_cart["_id"] = str(updated_cart["_id"])
+        def set_quantity(lines):
+            if key not in lines:
+                raise HTTPException(status_code=404, detail="Item not found in cart")
+            
+            if item["quantity"] <= 0:
+                # Remove item
+                del lines[key]
+            else:
+                lines[key]["quantity"] = item["quantity"]
+                lines[key]["total_price"] = lines[key]["size_price"] * item["quantity"]
+            return lines
         
-        return {"message": "Cart updated", "cart": updated_cart}
+        # Resize the stock hold before the line so an increase can't oversell
+        previous_hold = await set_hold(session_id, item["product_id"], item["size"], max(item["quantity"], 0))
+        try:
+            before, updated_cart = await update_cart_lines(session_id, set_quantity)
+        except Exception:
+            await set_hold(session_id, item["product_id"], item["size"], previous_hold)
+            raise
+        return {"message": "Cart updated", "cart": cart_response(updated_cart, view, [key], before)}
     
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.delete("/cart/{session_id}/remove")
-async def remove_from_cart(session_id: str, item: dict):
+async def remove_from_cart(session_id: str, item: dict, view: Optional[str] = None):
     """Remove item from cart"""
     try:
-        cart = await db.carts.find_one({"session_id": session_id})
-        if not cart:
-            raise HTTPException(status_code=404, detail="Cart not found")
+        view = cart_view_param(view)
+        key = line_key(item["product_id"], item["size"])
         
-        # Prepare update data
-        update_data = {
-            "$pull": {
-                "items": {
-                    "product_id": item["product_id"],
-                    "size": item["size"]
-                }
-            }
-        }
+        def remove_line(lines):
+            lines.pop(key, None)
+            return lines
         
-        # Calculate new totals
-        items = [i for i in cart.get("items", []) if not (i["product_id"] == item["product_id"] and i["size"] == item["size"])]
-        total_items = sum(i["quantity"] for i in items)
-        total_amount = sum(i["total_price"] for i in items)
-        
-        # Add totals to update data
-        update_data["$set"] = {
-            "total_items": total_items,
-            "total_amount": total_amount,
-            "updated_at": datetime.utcnow()
-        }
+        before, updated_cart = await update_cart_lines(session_id, remove_line)
+        await release_holds({"session_id": session_id, "product_id": item["product_id"], "size": item["size"]})
+        return {"message": "Item removed from cart", "cart": cart_response(updated_cart, view, [key], before)}
+    
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/cart/{session_id}/batch")
+async def batch_cart_operations(session_id: str, batch: CartBatch, view: Optional[str] = None):
+    """Apply several add/update/remove operations in one atomic cart write"""
+    try:
+        view = cart_view_param(view)
+        for operation in batch.operations:
+            if operation.op not in ("add", "update", "remove"):
+                raise HTTPException(status_code=400, detail=f"Unknown operation: {operation.op}")
+            if operation.op == "add" and operation.quantity < 1:
+                raise HTTPException(status_code=400, detail="Quantity must be a positive integer")
         
-        # Update cart in database
-        await db.carts.update_one(
-            {"session_id": session_id},
-            update_data
+        # One lookup for every product the batch adds or resizes
+        products = await get_product_snapshots(
+            operation.product_id for operation in batch.operations if operation.op != "remove"
         )
+        touched = {}
+        for operation in batch.operations:
+            touched[line_key(operation.product_id, operation.size)] = (operation.product_id, operation.size)
+            if operation.op == "remove":
+                continue
+            product = products.get(operation.product_id)
+            if not product:
+                raise HTTPException(status_code=404, detail=f"Product not found: {operation.product_id}")
+            if operation.size not in product.sizes:
+                raise HTTPException(status_code=400, detail=f"Size not found: {operation.size}")
+        
+        def apply_operations(lines):
+            for operation in batch.operations:
+                key = line_key(operation.product_id, operation.size)
+                if operation.op == "add":
+                    add_cart_line(lines, products[operation.product_id].cart_item(operation.size, operation.quantity))
+                elif operation.op == "update":
+                    if key not in lines:
+                        raise HTTPException(status_code=404, detail=f"Item not found in cart: {operation.product_id} / {operation.size}")
+                    if operation.quantity <= 0:
+                        del lines[key]
+                    else:
+                        lines[key]["quantity"] = operation.quantity
+                        lines[key]["total_price"] = lines[key]["size_price"] * operation.quantity
+                else:
+                    lines.pop(key, None)
+            return lines
         
-        # Get updated cart
-        updated_cart = await db.carts.find_one({"session_id": session_id})
-        if "_id" in updated_cart:
-            updated_cart["_id"] = str(updated_cart["_id"])
+        # Preview the batch on the current cart to size each touched line's hold
+        cart = await load_cart(session_id)
+        preview = apply_operations({key: dict(line) for key, line in (cart_lines(cart) if cart else {}).items()})
+        # Only adds start a cart; removing from one that doesn't exist writes nothing
+        creates = any(operation.op == "add" for operation in batch.operations)
+        if not cart and not creates:
+            return {"message": "Cart updated", "cart": cart_response(cart_document(Cart(session_id=session_id)), view, [])}
+        previous_holds = {}
+        try:
+            for key, (product_id, size) in touched.items():
+                target = preview[key]["quantity"] if key in preview else 0
+                previous_holds[key] = await set_hold(session_id, product_id, size, target)
+            before, updated_cart = await update_cart_lines(session_id, apply_operations, create=creates)
+        except Exception:
+            for key, previous in previous_holds.items():
+                await set_hold(session_id, *touched[key], previous)
+            raise
         
-        return {"message": "Item removed from cart", "cart": updated_cart}
+        # A concurrent change can make the written cart differ from the preview
+        written = cart_lines(updated_cart)
+        for key, (product_id, size) in touched.items():
+            quantity = written[key]["quantity"] if key in written else 0
+            if quantity != (preview[key]["quantity"] if key in preview else 0):
+                try:
+                    await set_hold(session_id, product_id, size, quantity)
+                except HTTPException as e:
+                    logger.warning(f"Could not realign stock hold for {session_id} {key}: {e.detail}")
+        return {"message": "Cart updated", "cart": cart_response(updated_cart, view, changed_line_keys(before, written), before)}
     
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -459,15 +2258,8 @@ async def remove_from_cart(session_id: str, item: dict):
 async def clear_cart(session_id: str):
     """Clear all items from cart"""
     try:
-        await db.carts.update_one(
-            {"session_id": session_id},
-            {"$set": {
-                "items": [],
-                "total_items": 0,
-                "total_amount": 0,
-                "updated_at": datetime.utcnow()
-            }}
-        )
+        await clear_cart_lines(session_id)
+        await release_holds({"session_id": session_id})
         return {"message": "Cart cleared"}
     
     except Exception as e:
@@ -475,11 +2267,43 @@ async def clear_cart(session_id: str):
 
 # Order API endpoints
 @api_router.post("/orders", response_model=Order)
-async def create_order(order_data: dict):
-    """Create a new order"""
+async def create_order(order_data: dict, idempotency_key: Optional[str] = Header(None)):
+    """Create a new order; retries with the same Idempotency-Key get the original response"""
+    if not idempotency_key:
+        return await submit_order(order_data)
+    
+    payload_hash = request_hash(order_data)
+    record, claim_id = await claim_idempotency_key("orders", idempotency_key, payload_hash)
+    if record is not None:
+        return JSONResponse(content=record["response"], headers={"Idempotent-Replayed": "true"})
+    
+    # An earlier holder of the key may have placed the order and then failed
+    existing = await db.orders.find_one({"idempotency_key": idempotency_key})
+    if existing is not None:
+        order = Order(**existing)
+    else:
+        try:
+            order = await submit_order(order_data, idempotency_key)
+        except Exception:
+            existing = await db.orders.find_one({"idempotency_key": idempotency_key})
+            if existing is None:
+                await release_idempotency_key("orders", idempotency_key, claim_id)
+                raise
+            # Lost an insert race to a request that took the claim over
+            order = Order(**existing)
+    
+    try:
+        await complete_idempotency_key("orders", idempotency_key, claim_id, jsonable_encoder(order))
+    except Exception as e:
+        # The order exists and carries the key, so a retry finds it once the lease expires
+        logger.error(f"Could not complete Idempotency-Key {idempotency_key} for order {order.order_number}: {e}")
+    return order
+
+async def submit_order(order_data: dict, idempotency_key: Optional[str] = None) -> Order:
+    """Validate an order request and check it out"""
     try:
         # Validate required fields
-        required_fields = ["customer_info", "items", "payment_method"]
+        required_fields = ["customer_info", "payment_method"]
         for field in required_fields:
             if field not in order_data:
                 raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
@@ -492,42 +2316,22 @@ async def create_order(order_data: dict):
                 if field not in customer_info:
                     raise HTTPException(status_code=400, detail=f"Missing required customer info field: {field}")
         
+        # The stored cart is the source of the order when there is one;
+        # otherwise only ids, sizes and quantities are taken from the request
+        cart = await load_cart(order_data["session_id"]) if order_data.get("session_id") else None
+        if cart and cart_lines(cart):
+            lines = [(line["product_id"], line["size"], line["quantity"]) for line in cart_lines(cart).values()]
+        else:
+            cart = None
+            if "items" not in order_data:
+                raise HTTPException(status_code=400, detail="Missing required field: items")
+            lines = requested_lines(order_data["items"])
+        
         # Validate items
-        if "items" in order_data and not order_data["items"]:
+        if not lines:
             raise HTTPException(status_code=400, detail="Order must contain at least one item")
         
-        # Calculate totals
-        subtotal = sum(item["total_price"] for item in order_data["items"])
-        shipping_fee = 30000 if order_data.get("payment_method") == "cod" else 0  # COD fee
-        total_amount = subtotal + shipping_fee - order_data.get("discount", 0)
-        
-        # Create order
-        order = Order(
-            customer_info=CustomerInfo(**order_data["customer_info"]),
-            items=[OrderItem(**item) for item in order_data["items"]],
-            payment_method=order_data["payment_method"],
-            subtotal=subtotal,
-            shipping_fee=shipping_fee,
-            discount=order_data.get("discount", 0),
-            total_amount=total_amount
-        )
-        
-        # Save to database
-        await db.orders.insert_one(order.dict())
-        
-        # Clear cart if session_id provided
-        if order_data.get("session_id"):
-            await db.carts.update_one(
-                {"session_id": order_data["session_id"]},
-                {"$set": {
-                    "items": [],
-                    "total_items": 0,
-                    "total_amount": 0,
-                    "updated_at": datetime.utcnow()
-                }}
-            )
-        
-        return order
+        return await checkout(order_data, lines, cart, idempotency_key)
     
     except HTTPException as e:
         # Re-raise HTTP exceptions
@@ -535,6 +2339,62 @@ async def create_order(order_data: dict):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def order_page(docs: List[dict], next_cursor: Optional[str]) -> OrderPage:
+    return OrderPage(items=[Order(**doc) for doc in docs], next_cursor=next_cursor)
+
+@api_router.get("/orders", response_model=OrderPage)
+async def list_orders(
+    order_status: Optional[str] = None,
+    payment_status: Optional[str] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    phone: Optional[str] = None,
+    email: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """List orders for staff, newest first.
+
+    Filters combine; ``created_from`` is inclusive and ``created_to`` exclusive.
+    Pass the returned ``next_cursor`` to fetch the following page.
+    """
+    query = {}
+    if order_status:
+        query["order_status"] = order_status
+    if payment_status:
+        query["payment_status"] = payment_status
+    if phone:
+        query["customer_info.phone"] = phone
+    if email:
+        query["customer_info.email"] = email
+    if created_from or created_to:
+        query["created_at"] = {}
+        if created_from:
+            query["created_at"]["$gte"] = created_from
+        if created_to:
+            query["created_at"]["$lt"] = created_to
+    
+    docs, next_cursor = await fetch_page(db.orders, query, limit, cursor)
+    return order_page(docs, next_cursor)
+
+@api_router.get("/orders/customer", response_model=CustomerOrderPage)
+async def customer_orders(
+    phone: Optional[str] = None,
+    email: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """Order history for the customer with this phone and email, newest first.
+
+    Both are required, so knowing one of them is not enough to read someone's
+    orders, and the delivery address is left out of the result.
+    """
+    if not phone or not email:
+        raise HTTPException(status_code=400, detail="Provide both phone and email")
+    
+    docs, next_cursor = await fetch_page(db.orders, {"customer_info.phone": phone, "customer_info.email": email}, limit, cursor)
+    return CustomerOrderPage(items=[CustomerOrder(**doc) for doc in docs], next_cursor=next_cursor)
+
 @api_router.get("/orders/{order_id}", response_model=Order)
 async def get_order(order_id: str):
     """Get order by ID"""
@@ -551,6 +2411,8 @@ async def get_order(order_id: str):
 @api_router.get("/orders/number/{order_number}", response_model=Order)
 async def get_order_by_number(order_number: str):
     """Get order by order number"""
+    if not is_valid_order_number(order_number):
+        raise HTTPException(status_code=404, detail="Order not found")
     order = await db.orders.find_one({"order_number": order_number})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
@@ -561,6 +2423,42 @@ async def get_order_by_number(order_number: str):
     
     return Order(**order)
 
+# Admin API endpoints
+@api_router.get("/admin/metrics")
+async def get_metrics():
+    """Operational counters"""
+    return metrics
+
+@api_router.get("/admin/indexes")
+async def get_index_status():
+    """Report index build state and any route query running as a collection scan"""
+    collections = {}
+    for collection in INDEXES:
+        existing = await db[collection].index_information()
+        collections[collection] = {
+            "state": index_state["collections"].get(collection, "pending"),
+            "indexes": sorted(existing),
+            "missing": [model.document["name"] for model in INDEXES[collection] if model.document["name"] not in existing]
+        }
+    
+    # Index builds still in flight (needs the inprog privilege, so best effort)
+    in_progress = []
+    try:
+        async for op in client.admin.aggregate([
+            {"$currentOp": {}},
+            {"$match": {"command.createIndexes": {"$exists": True}}}
+        ]):
+            in_progress.append({"namespace": op.get("ns"), "progress": op.get("msg")})
+    except OperationFailure:
+        pass
+    
+    return {
+        "status": index_state["status"],
+        "collections": collections,
+        "in_progress": in_progress,
+        "collscans": await find_collscans()
+    }
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -582,6 +2480,13 @@ logger = logging.getLogger(__name__)
 @app.on_event("startup")
 async def startup_event():
     """Initialize the database with sample products"""
+    # Build indexes in the background so a large collection doesn't delay startup
+    app.state.index_task = asyncio.create_task(ensure_indexes())
+    if cart_engine is not None:
+        cart_engine.start()
+    app.state.reservation_task = asyncio.create_task(sweep_expired_holds())
+    job_queue.start()
+    
     # Check if products already exist
     existing_products = await db.products.count_documents({})
     if existing_products == 0:
@@ -713,9 +2618,13 @@ async def startup_event():
             }
         ]
         
-        await db.products.insert_many(sample_products)
+        await db.products.insert_many([{**product, **derived_fields(product)} for product in sample_products])
         logger.info("Sample products inserted successfully")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    app.state.reservation_task.cancel()
+    await job_queue.stop()
+    if cart_engine is not None:
+        await cart_engine.stop()
     client.close()
\ No newline at end of file
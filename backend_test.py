@@ -3,6 +3,7 @@ import requests
 import json
 import sys
 import os
+import uuid
 from pprint import pprint
 
 # Get the backend URL from the frontend .env file
@@ -33,9 +34,16 @@ class AgarwoodAPITester:
             "health_check": False,
             "get_products": False,
             "get_featured_products": False,
+            "products_pagination": False,
+            "search_products": False,
+            "products_etag": False,
+            "batch_lookup": False,
+            "import_export": False,
+            "product_facets": False,
             "create_product": False,
             "get_product_by_id": False,
             "update_product": False,
+            "update_product_held_stock": False,
             "delete_product": False,
             "sample_data": False,
             # Shopping Cart API tests
@@ -44,10 +52,16 @@ class AgarwoodAPITester:
             "update_cart_item": False,
             "remove_from_cart": False,
             "clear_cart": False,
+            "cart_batch": False,
+            "cart_delta": False,
             # Order Management API tests
             "create_order": False,
+            "order_idempotency": False,
+            "order_server_pricing": False,
+            "order_oversell": False,
             "get_order_by_id": False,
-            "get_order_by_number": False
+            "get_order_by_number": False,
+            "list_orders": False
         }
         self.sample_product = {
             "name": "Trầm Hương Xông Phòng",
@@ -85,9 +99,16 @@ class AgarwoodAPITester:
         self.test_health_check()
         self.test_get_products()
         self.test_get_featured_products()
+        self.test_products_pagination()
+        self.test_search_products()
+        self.test_products_etag()
+        self.test_batch_lookup()
+        self.test_import_export()
+        self.test_product_facets()
         self.test_create_product()
         self.test_get_product_by_id()
         self.test_update_product()
+        self.test_update_product_held_stock()
         
         # Shopping Cart API tests
         print("\n=== Testing Shopping Cart APIs ===\n")
@@ -96,12 +117,18 @@ class AgarwoodAPITester:
         self.test_update_cart_item()
         self.test_remove_from_cart()
         self.test_clear_cart()
+        self.test_cart_batch()
+        self.test_cart_delta()
         
         # Order Management API tests
         print("\n=== Testing Order Management APIs ===\n")
         self.test_create_order()
+        self.test_order_idempotency()
+        self.test_order_server_pricing()
+        self.test_order_oversell()
         self.test_get_order_by_id()
         self.test_get_order_by_number()
+        self.test_list_orders()
         
         # Clean up
         self.test_delete_product()
@@ -291,6 +318,151 @@ class AgarwoodAPITester:
         except Exception as e:
             print(f"❌ Get Featured Products: FAILED - {str(e)}")
     
+    def test_products_pagination(self):
+        """Test walking the product listing with keyset cursors"""
+        print("\n--- Testing Products Pagination ---")
+        try:
+            full_response = requests.get(f"{self.api_url}/products")
+            all_ids = [product.get("id") for product in full_response.json()]
+            
+            seen_ids = []
+            params = {"limit": 2}
+            while True:
+                response = requests.get(f"{self.api_url}/products", params=params)
+                if response.status_code != 200:
+                    print(f"❌ Products Pagination: FAILED - {response.text}")
+                    return
+                page = response.json()
+                if len(page.get("items", [])) > 2:
+                    print(f"❌ Page exceeds limit: {len(page['items'])} items")
+                    return
+                seen_ids.extend(product.get("id") for product in page.get("items", []))
+                if not page.get("next_cursor"):
+                    break
+                params = {"limit": 2, "cursor": page["next_cursor"]}
+            
+            print(f"Walked {len(seen_ids)} products in pages of 2")
+            if seen_ids == all_ids:
+                print("✅ Pages cover the full listing in order without duplicates")
+            else:
+                print("❌ Paged listing does not match the full listing")
+                return
+            
+            # Malformed cursors are rejected
+            response = requests.get(f"{self.api_url}/products", params={"cursor": "not-a-cursor"})
+            if response.status_code == 400:
+                print("✅ Invalid cursor correctly returns 400")
+                self.test_results["products_pagination"] = True
+                print("✅ Products Pagination: SUCCESS")
+            else:
+                print(f"❌ Invalid cursor returned unexpected status: {response.status_code}")
+        except Exception as e:
+            print(f"❌ Products Pagination: FAILED - {str(e)}")
+    
+    def test_search_products(self):
+        """Test diacritic-insensitive product search"""
+        print("\n--- Testing Search Products ---")
+        try:
+            # Unaccented query should match the accented Vietnamese names
+            response = requests.get(f"{self.api_url}/products/search", params={"q": "tram huong ky nam"})
+            print(f"Status Code: {response.status_code}")
+            
+            if response.status_code == 200:
+                result = response.json()
+                items = result.get("items", [])
+                print(f"Found {len(items)} matching products")
+                
+                if items and items[0].get("name") == "Trầm Hương Kỳ Nam Cao Cấp":
+                    print("✅ Best match ranked first: Trầm Hương Kỳ Nam Cao Cấp")
+                    self.test_results["search_products"] = True
+                    print("✅ Search Products: SUCCESS")
+                else:
+                    print(f"❌ Unexpected ranking: {[item.get('name') for item in items]}")
+            else:
+                print(f"❌ Search Products: FAILED - {response.text}")
+            
+            # English names are searchable too
+            response = requests.get(f"{self.api_url}/products/search", params={"q": "agarwood", "limit": 2})
+            if response.status_code == 200 and len(response.json().get("items", [])) <= 2:
+                print(f"✅ English search with limit: {len(response.json()['items'])} items, has_more={response.json().get('has_more')}")
+            else:
+                print(f"❌ English search returned unexpected result: {response.status_code}")
+        except Exception as e:
+            print(f"❌ Search Products: FAILED - {str(e)}")
+    
+    def test_products_etag(self):
+        """Test conditional GETs on the product listing"""
+        print("\n--- Testing Products ETag ---")
+        try:
+            response = requests.get(f"{self.api_url}/products")
+            etag = response.headers.get("ETag")
+            print(f"Status Code: {response.status_code}, ETag: {etag}")
+            
+            if response.status_code != 200 or not etag:
+                print("❌ Products ETag: FAILED - No ETag on listing response")
+                return
+            
+            response = requests.get(f"{self.api_url}/products", headers={"If-None-Match": etag})
+            if response.status_code == 304 and not response.content:
+                self.test_results["products_etag"] = True
+                print("✅ Products ETag: SUCCESS - Matching If-None-Match returns 304")
+            else:
+                print(f"❌ Products ETag: FAILED - Expected 304, got {response.status_code}")
+        except Exception as e:
+            print(f"❌ Products ETag: FAILED - {str(e)}")
+    
+    def test_batch_lookup(self):
+        """Test resolving several product IDs in one request"""
+        print("\n--- Testing Batch Product Lookup ---")
+        try:
+            products = requests.get(f"{self.api_url}/products").json()
+            if len(products) < 2:
+                print("❌ Batch Lookup: FAILED - Need at least 2 products")
+                return
+            
+            # Request in reverse listing order with one unknown ID
+            requested_ids = [products[1]["id"], "non-existent-product", products[0]["id"]]
+            response = requests.get(f"{self.api_url}/products", params={"ids": ",".join(requested_ids)})
+            print(f"Status Code: {response.status_code}")
+            
+            if response.status_code == 200:
+                result = response.json()
+                returned_ids = [item.get("id") for item in result.get("items", [])]
+                if returned_ids == [products[1]["id"], products[0]["id"]] and result.get("missing") == ["non-existent-product"]:
+                    self.test_results["batch_lookup"] = True
+                    print("✅ Batch Lookup: SUCCESS - Requested order preserved and missing ID reported")
+                else:
+                    print(f"❌ Batch Lookup: FAILED - Got {returned_ids}, missing {result.get('missing')}")
+            else:
+                print(f"❌ Batch Lookup: FAILED - {response.text}")
+        except Exception as e:
+            print(f"❌ Batch Lookup: FAILED - {str(e)}")
+    
+    def test_product_facets(self):
+        """Test facet counts against the full product listing"""
+        print("\n--- Testing Product Facets ---")
+        try:
+            products = requests.get(f"{self.api_url}/products").json()
+            response = requests.get(f"{self.api_url}/products/facets")
+            print(f"Status Code: {response.status_code}")
+            
+            if response.status_code == 200:
+                facets = response.json()
+                category_total = sum(group["count"] for group in facets.get("categories", []))
+                band_total = sum(band["count"] for band in facets.get("price_bands", []))
+                stock_total = sum(facets.get("stock", {}).values())
+                print(f"Categories: {[(group['category'], group['count']) for group in facets.get('categories', [])]}")
+                
+                if category_total == band_total == stock_total == len(products):
+                    self.test_results["product_facets"] = True
+                    print(f"✅ Product Facets: SUCCESS - Every facet covers all {len(products)} products")
+                else:
+                    print(f"❌ Product Facets: FAILED - Totals {category_total}/{band_total}/{stock_total} vs {len(products)} products")
+            else:
+                print(f"❌ Product Facets: FAILED - {response.text}")
+        except Exception as e:
+            print(f"❌ Product Facets: FAILED - {str(e)}")
+    
     def test_create_product(self):
         """Test creating a new product"""
         print("\n--- Testing Create Product ---")
@@ -520,6 +692,102 @@ class AgarwoodAPITester:
         except Exception as e:
             print(f"❌ Update Product: FAILED - {str(e)}")
     
+    def test_update_product_held_stock(self):
+        """Test that saving a product back keeps stock held by carts reserved, not lost"""
+        print("\n--- Testing Update Product With Held Stock ---")
+        product = None
+        session_id = f"test-held-{uuid.uuid4()}"
+        try:
+            product = self.create_checkout_product(stock=5)
+            response = requests.post(
+                f"{self.api_url}/cart/{session_id}/add",
+                json={"product_id": product["id"], "size": "Nhỏ (5g)", "quantity": 2}
+            )
+            response.raise_for_status()
+            
+            # GET shows the 3 units free to reserve; sending them back unchanged keeps 3
+            fetched = requests.get(f"{self.api_url}/products/{product['id']}").json()
+            size_options = [{**option, "price": 260000} for option in fetched["size_options"]]
+            response = requests.put(f"{self.api_url}/products/{product['id']}", json={"size_options": size_options})
+            print(f"Status Code: {response.status_code}")
+            saved = response.json()["size_options"][0]["stock"]
+            stored = requests.get(f"{self.api_url}/products/{product['id']}").json()["size_options"][0]["stock"]
+            print(f"Stock before: {fetched['size_options'][0]['stock']}, in PUT response: {saved}, after: {stored}")
+            if response.status_code != 200 or saved != 3 or stored != 3:
+                print("❌ Update Product With Held Stock: FAILED - Held units were subtracted again")
+                return
+            
+            # With on_hand the 2 held units are part of what was sent
+            size_options[0]["stock"] = 6
+            response = requests.put(
+                f"{self.api_url}/products/{product['id']}",
+                params={"on_hand": "true"},
+                json={"size_options": size_options}
+            )
+            saved = response.json()["size_options"][0]["stock"]
+            stored = requests.get(f"{self.api_url}/products/{product['id']}").json()["size_options"][0]["stock"]
+            print(f"On hand sent: 6, in PUT response: {saved}, free to reserve: {stored}")
+            if response.status_code == 200 and saved == 6 and stored == 4:
+                self.test_results["update_product_held_stock"] = True
+                print("✅ Update Product With Held Stock: SUCCESS - Held stock survives GET → PUT")
+            else:
+                print("❌ Update Product With Held Stock: FAILED - On hand stock was not applied")
+        except Exception as e:
+            print(f"❌ Update Product With Held Stock: FAILED - {str(e)}")
+        finally:
+            requests.delete(f"{self.api_url}/cart/{session_id}/clear")
+            if product:
+                requests.delete(f"{self.api_url}/products/{product['id']}")
+    
+    def test_import_export(self):
+        """Test that an exported product imports back as is and bad lines are reported"""
+        print("\n--- Testing Product Import/Export ---")
+        product = None
+        try:
+            response = requests.post(f"{self.api_url}/products", json={**self.sample_product, "featured": False})
+            response.raise_for_status()
+            product = response.json()
+            
+            response = requests.get(f"{self.api_url}/products/export")
+            print(f"Export Status Code: {response.status_code}")
+            exported = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+            exported = next((line for line in exported if line["id"] == product["id"]), None)
+            if response.status_code != 200 or exported is None:
+                print("❌ Import/Export: FAILED - Product missing from export")
+                return
+            
+            exported["name"] = "Trầm Hương Nhập Lại"
+            invalid = {key: value for key, value in exported.items() if key not in ("id", "name")}
+            body = "\n".join([json.dumps(exported, ensure_ascii=False), '{"name": "broken', json.dumps(invalid, ensure_ascii=False)])
+            response = requests.post(
+                f"{self.api_url}/products/import",
+                data=body.encode("utf-8"),
+                headers={"Content-Type": "application/x-ndjson"}
+            )
+            print(f"Import Status Code: {response.status_code}")
+            if response.status_code != 200:
+                print(f"❌ Import/Export: FAILED - {response.text}")
+                return
+            
+            report = response.json()
+            print(f"Report: {report}")
+            if (report["processed"] != 3 or report["inserted"] != 0 or report["updated"] != 1
+                    or report["failed"] != 2 or [error["line"] for error in report["errors"]] != [2, 3]):
+                print("❌ Import/Export: FAILED - Unexpected import report")
+                return
+            
+            imported = requests.get(f"{self.api_url}/products/{product['id']}").json()
+            if imported["name"] == "Trầm Hương Nhập Lại" and imported["size_options"] == exported["size_options"]:
+                self.test_results["import_export"] = True
+                print("✅ Import/Export: SUCCESS - Round trip kept the product and bad lines were reported")
+            else:
+                print("❌ Import/Export: FAILED - Imported product does not match the export")
+        except Exception as e:
+            print(f"❌ Import/Export: FAILED - {str(e)}")
+        finally:
+            if product:
+                requests.delete(f"{self.api_url}/products/{product['id']}")
+    
     def test_delete_product(self):
         """Test deleting a product"""
         print("\n--- Testing Delete Product ---")
@@ -1054,6 +1322,100 @@ class AgarwoodAPITester:
             print(f"❌ Clear Cart: FAILED - {str(e)}")
     
     # Order Management API Tests
+    def test_cart_batch(self):
+        """Test applying several cart operations in one request"""
+        print("\n--- Testing Cart Batch Operations ---")
+        batch_session_id = "test_session_batch"
+        try:
+            products = requests.get(f"{self.api_url}/products").json()
+            product = products[0]
+            sizes = [option["size"] for option in product.get("size_options", [])]
+            if len(sizes) < 2:
+                print("❌ Cart Batch: FAILED - Product needs at least 2 sizes")
+                return
+            
+            requests.delete(f"{self.api_url}/cart/{batch_session_id}/clear")
+            operations = [
+                {"op": "add", "product_id": product["id"], "size": sizes[0], "quantity": 2},
+                {"op": "add", "product_id": product["id"], "size": sizes[1], "quantity": 1},
+                {"op": "update", "product_id": product["id"], "size": sizes[0], "quantity": 1},
+                {"op": "remove", "product_id": product["id"], "size": sizes[1]}
+            ]
+            response = requests.post(f"{self.api_url}/cart/{batch_session_id}/batch", json={"operations": operations})
+            print(f"Status Code: {response.status_code}")
+            
+            if response.status_code == 200:
+                cart = response.json().get("cart", {})
+                items = cart.get("items", [])
+                print(f"Cart after batch: {[(item['size'], item['quantity']) for item in items]}")
+                if len(items) == 1 and items[0]["size"] == sizes[0] and cart.get("total_items") == 1:
+                    print("✅ Batch operations applied in order")
+                else:
+                    print("❌ Cart Batch: FAILED - Unexpected cart contents")
+                    return
+            else:
+                print(f"❌ Cart Batch: FAILED - {response.text}")
+                return
+            
+            # A failing operation leaves the cart untouched
+            operations = [
+                {"op": "add", "product_id": product["id"], "size": sizes[1], "quantity": 1},
+                {"op": "add", "product_id": product["id"], "size": "Không tồn tại", "quantity": 1}
+            ]
+            response = requests.post(f"{self.api_url}/cart/{batch_session_id}/batch", json={"operations": operations})
+            cart = requests.get(f"{self.api_url}/cart/{batch_session_id}").json()
+            if response.status_code == 400 and cart.get("total_items") == 1:
+                self.test_results["cart_batch"] = True
+                print("✅ Cart Batch: SUCCESS - Invalid batch rejected without partial writes")
+            else:
+                print(f"❌ Cart Batch: FAILED - Status {response.status_code}, total items {cart.get('total_items')}")
+        except Exception as e:
+            print(f"❌ Cart Batch: FAILED - {str(e)}")
+        finally:
+            requests.delete(f"{self.api_url}/cart/{batch_session_id}/clear")
+    
+    def test_cart_delta(self):
+        """Test delta responses from cart mutations"""
+        print("\n--- Testing Cart Delta Responses ---")
+        delta_session_id = "test_session_delta"
+        try:
+            products = requests.get(f"{self.api_url}/products").json()
+            first, second = products[0], products[1]
+            first_size = first["size_options"][0]["size"]
+            second_size = second["size_options"][0]["size"]
+            
+            requests.delete(f"{self.api_url}/cart/{delta_session_id}/clear")
+            requests.post(f"{self.api_url}/cart/{delta_session_id}/add", json={"product_id": first["id"], "size": first_size, "quantity": 1})
+            response = requests.post(
+                f"{self.api_url}/cart/{delta_session_id}/add?view=delta",
+                json={"product_id": second["id"], "size": second_size, "quantity": 1}
+            )
+            print(f"Status Code: {response.status_code}")
+            
+            if response.status_code != 200:
+                print(f"❌ Cart Delta: FAILED - {response.text}")
+                return
+            delta = response.json().get("cart", {})
+            print(f"Delta: {len(delta.get('items', []))} changed line(s), total items {delta.get('total_items')}, version {delta.get('version')}")
+            if len(delta.get("items", [])) != 1 or delta.get("total_items") != 2 or "version" not in delta:
+                print("❌ Cart Delta: FAILED - Delta should hold only the added line and the new totals")
+                return
+            
+            response = requests.delete(
+                f"{self.api_url}/cart/{delta_session_id}/remove?view=delta",
+                json={"product_id": first["id"], "size": first_size}
+            )
+            delta = response.json().get("cart", {})
+            if response.status_code == 200 and delta.get("items") == [] and delta.get("removed") == [{"product_id": first["id"], "size": first_size}]:
+                self.test_results["cart_delta"] = True
+                print("✅ Cart Delta: SUCCESS - Mutations return only changed lines")
+            else:
+                print(f"❌ Cart Delta: FAILED - Unexpected remove delta: {delta}")
+        except Exception as e:
+            print(f"❌ Cart Delta: FAILED - {str(e)}")
+        finally:
+            requests.delete(f"{self.api_url}/cart/{delta_session_id}/clear")
+    
     def test_create_order(self):
         """Test creating a new order"""
         print("\n--- Testing Create Order ---")
@@ -1284,6 +1646,151 @@ class AgarwoodAPITester:
         except Exception as e:
             print(f"❌ Create Order: FAILED - {str(e)}")
     
+    def test_order_idempotency(self):
+        """Test that retried order requests with the same Idempotency-Key create one order"""
+        print("\n--- Testing Order Idempotency ---")
+        try:
+            products = requests.get(f"{self.api_url}/products").json()
+            product = products[0]
+            order_data = {
+                "customer_info": {
+                    "full_name": "Nguyễn Văn B",
+                    "phone": "0912345678",
+                    "email": "nguyenvanb@example.com",
+                    "address": "45 Đường Hai Bà Trưng",
+                    "city": "Hồ Chí Minh",
+                    "district": "Quận 3",
+                    "ward": "Phường 6"
+                },
+                "items": [{"product_id": product["id"], "size": product["size_options"][0]["size"], "quantity": 1}],
+                "payment_method": "bank_transfer"
+            }
+            headers = {"Idempotency-Key": str(uuid.uuid4())}
+            
+            first = requests.post(f"{self.api_url}/orders", json=order_data, headers=headers)
+            retry = requests.post(f"{self.api_url}/orders", json=order_data, headers=headers)
+            print(f"Status Codes: {first.status_code}, {retry.status_code}")
+            
+            if first.status_code != 200 or retry.status_code != 200:
+                print(f"❌ Order Idempotency: FAILED - {first.text} / {retry.text}")
+                return
+            if first.json()["id"] != retry.json()["id"]:
+                print("❌ Order Idempotency: FAILED - Retry created a second order")
+                return
+            print(f"✅ Retry returned the original order: {first.json()['order_number']}")
+            
+            # Reusing the key for a different request is rejected
+            order_data["payment_method"] = "cod"
+            response = requests.post(f"{self.api_url}/orders", json=order_data, headers=headers)
+            if response.status_code == 422:
+                self.test_results["order_idempotency"] = True
+                print("✅ Order Idempotency: SUCCESS - Key reuse with a different body rejected")
+            else:
+                print(f"❌ Order Idempotency: FAILED - Expected 422 for key reuse, Got {response.status_code}")
+        except Exception as e:
+            print(f"❌ Order Idempotency: FAILED - {str(e)}")
+    
+    def create_checkout_product(self, stock):
+        """Create a throwaway product with one size holding ``stock`` units"""
+        product = {
+            **self.sample_product,
+            "name": "Trầm Hương Kiểm Tra Thanh Toán",
+            "featured": False,
+            "size_options": [{"size": "Nhỏ (5g)", "price": 250000, "original_price": 300000, "stock": stock}]
+        }
+        response = requests.post(f"{self.api_url}/products", json=product)
+        response.raise_for_status()
+        return response.json()
+    
+    def checkout_order(self, product, quantity, **overrides):
+        item = {"product_id": product["id"], "size": "Nhỏ (5g)", "quantity": quantity}
+        order_data = {
+            "customer_info": {
+                "full_name": "Trần Thị C",
+                "phone": "0901234567",
+                "email": "tranthic@example.com",
+                "address": "9 Đường Nguyễn Huệ",
+                "city": "Hồ Chí Minh",
+                "district": "Quận 1",
+                "ward": "Phường Bến Nghé"
+            },
+            "items": [{**item, **overrides.pop("item", {})}],
+            "payment_method": "bank_transfer",
+            **overrides
+        }
+        return requests.post(f"{self.api_url}/orders", json=order_data)
+    
+    def test_order_server_pricing(self):
+        """Test that orders are priced from the catalog, ignoring client prices and discount"""
+        print("\n--- Testing Order Server Pricing ---")
+        product = None
+        try:
+            product = self.create_checkout_product(stock=5)
+            response = self.checkout_order(
+                product, 2,
+                item={"size_price": 1, "total_price": 2, "product_name": "Giá giả"},
+                discount=10000000,
+                subtotal=2,
+                total_amount=2
+            )
+            print(f"Status Code: {response.status_code}")
+            if response.status_code != 200:
+                print(f"❌ Order Server Pricing: FAILED - {response.text}")
+                return
+            
+            order = response.json()
+            item = order["items"][0]
+            print(f"Charged: {item['size_price']} x {item['quantity']}, subtotal {order['subtotal']}, discount {order['discount']}, total {order['total_amount']}")
+            if (item["size_price"] == 250000 and item["total_price"] == 500000 and item["product_name"] == product["name"]
+                    and order["subtotal"] == 500000 and order["discount"] == 0 and order["total_amount"] == 500000):
+                self.test_results["order_server_pricing"] = True
+                print("✅ Order Server Pricing: SUCCESS - Client prices and discount ignored")
+            else:
+                print("❌ Order Server Pricing: FAILED - Order used client-supplied amounts")
+        except Exception as e:
+            print(f"❌ Order Server Pricing: FAILED - {str(e)}")
+        finally:
+            if product:
+                requests.delete(f"{self.api_url}/products/{product['id']}")
+    
+    def test_order_oversell(self):
+        """Test that checkout takes stock and refuses orders beyond what is left"""
+        print("\n--- Testing Order Oversell ---")
+        product = None
+        try:
+            product = self.create_checkout_product(stock=3)
+            
+            response = self.checkout_order(product, 4)
+            print(f"Ordering 4 of 3: Status Code {response.status_code}")
+            if response.status_code != 400:
+                print(f"❌ Order Oversell: FAILED - Expected 400, Got {response.status_code}")
+                return
+            
+            response = self.checkout_order(product, 2)
+            print(f"Ordering 2 of 3: Status Code {response.status_code}")
+            if response.status_code != 200:
+                print(f"❌ Order Oversell: FAILED - {response.text}")
+                return
+            
+            # Only 1 unit is left, so a second order for 2 must fail
+            response = self.checkout_order(product, 2)
+            print(f"Ordering 2 of the remaining 1: Status Code {response.status_code}")
+            if response.status_code != 400:
+                print(f"❌ Order Oversell: FAILED - Stock was not decremented (Got {response.status_code})")
+                return
+            
+            response = self.checkout_order(product, 1)
+            if response.status_code == 200:
+                self.test_results["order_oversell"] = True
+                print("✅ Order Oversell: SUCCESS - Stock decremented and overselling rejected")
+            else:
+                print(f"❌ Order Oversell: FAILED - Last unit could not be ordered: {response.text}")
+        except Exception as e:
+            print(f"❌ Order Oversell: FAILED - {str(e)}")
+        finally:
+            if product:
+                requests.delete(f"{self.api_url}/products/{product['id']}")
+    
     def test_get_order_by_id(self):
         """Test getting an order by ID"""
         print("\n--- Testing Get Order by ID ---")
@@ -1356,6 +1863,54 @@ class AgarwoodAPITester:
         except Exception as e:
             print(f"❌ Get Order by ID: FAILED - {str(e)}")
     
+    def test_list_orders(self):
+        """Test paginated order listing and customer order history"""
+        print("\n--- Testing List Orders ---")
+        try:
+            response = requests.get(f"{self.api_url}/orders", params={"limit": 1})
+            print(f"Status Code: {response.status_code}")
+            if response.status_code != 200:
+                print(f"❌ List Orders: FAILED - {response.text}")
+                return
+            
+            first_page = response.json()
+            print(f"First page: {len(first_page['items'])} order(s), next_cursor {'set' if first_page.get('next_cursor') else 'empty'}")
+            if first_page.get("next_cursor"):
+                response = requests.get(f"{self.api_url}/orders", params={"limit": 1, "cursor": first_page["next_cursor"]})
+                second_page = response.json()
+                if second_page["items"] and second_page["items"][0]["id"] == first_page["items"][0]["id"]:
+                    print("❌ List Orders: FAILED - Second page repeats the first")
+                    return
+                print("✅ Cursor returns the next page")
+            
+            response = requests.get(
+                f"{self.api_url}/orders/customer",
+                params={"phone": "0987654321", "email": "nguyenvana@example.com", "limit": 50}
+            )
+            orders = response.json().get("items", [])
+            if response.status_code == 200 and orders and all(
+                order["customer_info"]["phone"] == "0987654321" and order["customer_info"]["email"] == "nguyenvana@example.com"
+                for order in orders
+            ):
+                print(f"✅ Customer history: {len(orders)} order(s)")
+            else:
+                print(f"❌ List Orders: FAILED - Customer history: {response.text}")
+                return
+            
+            exposed = [field for field in ("address", "district", "ward") if field in orders[0]["customer_info"]]
+            if exposed:
+                print(f"❌ List Orders: FAILED - Customer history exposes {', '.join(exposed)}")
+                return
+            
+            response = requests.get(f"{self.api_url}/orders/customer", params={"phone": "0987654321"})
+            if response.status_code == 400:
+                self.test_results["list_orders"] = True
+                print("✅ List Orders: SUCCESS")
+            else:
+                print(f"❌ List Orders: FAILED - Expected 400 with only a phone, Got {response.status_code}")
+        except Exception as e:
+            print(f"❌ List Orders: FAILED - {str(e)}")
+    
     def test_get_order_by_number(self):
         """Test getting an order by order number"""
         print("\n--- Testing Get Order by Number ---")
@@ -0,0 +1,172 @@
+"""Post-order job queue tests, run against the MongoDB in backend/.env with the in-memory sink"""
+import asyncio
+import sys
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+import server  # noqa: E402
+
+
+def with_database(test):
+    """Run ``test(db)`` against a throwaway database that server.db points at"""
+    async def main():
+        client = AsyncIOMotorClient(server.mongo_url, serverSelectionTimeoutMS=2000)
+        try:
+            await client.admin.command("ping")
+        except Exception:
+            client.close()
+            pytest.skip("MongoDB is not reachable")
+
+        db = client[f"job_queue_test_{uuid.uuid4().hex[:8]}"]
+        original_db = server.db
+        server.db = db
+        try:
+            await test(db)
+        finally:
+            server.db = original_db
+            await client.drop_database(db.name)
+            client.close()
+    asyncio.run(main())
+
+
+async def insert_order(db) -> dict:
+    order = server.Order(
+        order_number="KTH20250101000018",
+        customer_info=server.CustomerInfo(
+            full_name="Nguyễn Văn A",
+            phone="0987654321",
+            email="nguyenvana@example.com",
+            address="123 Đường Lê Lợi",
+            city="Hồ Chí Minh",
+            district="Quận 1",
+            ward="Phường Bến Nghé"
+        ),
+        items=[server.OrderItem(
+            product_id="product-1",
+            product_name="Trầm Hương Sáng",
+            product_image="https://example.com/image.jpg",
+            size="Nhỏ (5g)",
+            size_price=300000,
+            quantity=2,
+            total_price=600000
+        )],
+        payment_method="cod",
+        subtotal=600000,
+        shipping_fee=30000,
+        total_amount=630000
+    ).dict()
+    await db.orders.insert_one(order)
+    return order
+
+
+async def wait_for(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not await condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.05)
+
+
+def test_enqueued_jobs_reach_the_sink():
+    async def test(db):
+        order = await insert_order(db)
+        await db.order_jobs.insert_many(server.order_jobs(order["id"]))
+        sink = server.MemorySink()
+        queue = server.JobQueue(db.order_jobs, sink, 2)
+        queue.start()
+        queue.notify()
+        try:
+            async def all_sent():
+                return len(sink.messages) == len(server.ORDER_JOB_TYPES)
+            await wait_for(all_sent)
+        finally:
+            await queue.stop()
+
+        assert sorted(channel for channel, _ in sink.messages) == sorted(server.ORDER_JOB_TYPES)
+        confirmation = dict(sink.messages)["order_confirmation"]
+        assert confirmation["to"] == "nguyenvana@example.com"
+        assert confirmation["order_number"] == order["order_number"]
+        assert await db.order_jobs.count_documents({"status": "done", "finished_at": {"$exists": True}}) == 3
+    with_database(test)
+
+
+def test_failed_job_is_retried_with_backoff(monkeypatch):
+    monkeypatch.setattr(server, "JOB_RETRY_DELAY", 10)
+
+    async def test(db):
+        # No such order, so every attempt fails
+        await db.order_jobs.insert_many(server.order_jobs("missing-order")[:1])
+        queue = server.JobQueue(db.order_jobs, server.MemorySink(), 1)
+
+        for attempt, delay in [(1, 10), (2, 20)]:
+            job = await queue.claim()
+            assert job["attempts"] == attempt
+            started = datetime.utcnow()
+            await queue.run(job)
+
+            job = await db.order_jobs.find_one({"id": job["id"]})
+            assert job["status"] == "pending"
+            assert "Order not found" in job["last_error"]
+            assert abs((job["run_at"] - started).total_seconds() - delay) < 1
+            # Not due yet
+            assert await queue.claim() is None
+            await db.order_jobs.update_one({"id": job["id"]}, {"$set": {"run_at": datetime.utcnow() - timedelta(seconds=1)}})
+    with_database(test)
+
+
+def test_job_is_dead_lettered_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(server, "JOB_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(server, "JOB_RETRY_DELAY", 0)
+
+    async def test(db):
+        await db.order_jobs.insert_many(server.order_jobs("missing-order")[:1])
+        queue = server.JobQueue(db.order_jobs, server.MemorySink(), 1)
+        dead_before = server.metrics["jobs_dead"]
+
+        for _ in range(2):
+            await queue.run(await queue.claim())
+
+        job = await db.order_jobs.find_one({})
+        assert job["status"] == "dead"
+        assert job["attempts"] == 2
+        assert "locked_until" not in job
+        assert server.metrics["jobs_dead"] == dead_before + 1
+        assert await queue.claim() is None
+    with_database(test)
+
+
+def test_worker_survives_a_failed_status_write(monkeypatch):
+    monkeypatch.setattr(server, "JOB_LEASE_SECONDS", 0.2)
+    monkeypatch.setattr(server, "JOB_POLL_INTERVAL", 0.05)
+
+    async def test(db):
+        order = await insert_order(db)
+        await db.order_jobs.insert_many(server.order_jobs(order["id"])[:1])
+        sink = server.MemorySink()
+        queue = server.JobQueue(db.order_jobs, sink, 1)
+
+        real_run = queue.run
+        failures = []
+
+        async def flaky_run(job):
+            if not failures:
+                failures.append(job["id"])
+                raise ConnectionError("connection reset")
+            await real_run(job)
+
+        queue.run = flaky_run
+        queue.start()
+        try:
+            async def sent():
+                return len(sink.messages) == 1
+            # The same worker picks the job up again once its lease expires
+            await wait_for(sent)
+            assert not any(task.done() for task in queue._tasks)
+        finally:
+            await queue.stop()
+        assert failures
+    with_database(test)